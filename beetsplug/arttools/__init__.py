@@ -47,7 +47,14 @@ class ArtToolsPlugin(BeetsPlugin):
                 'bytes': 0.2
             },
             'host': u'127.0.0.1',
-            'port': 8338
+            'port': 8338,
+            'probe_threads': 4,
+            'x_sendfile': False,
+            'thumb_cache_dir': None,
+            'thumb_format': u'jpeg',
+            'load_max_size': 20 * 1024 * 1024,
+            'load_timeout': 30,
+            'accept_state_file': None
         })
 
     def commands(self):
@@ -2,6 +2,24 @@ $(function() {
 
 var app = {};
 
+// Poll the state of a background job until it is finished. progress is
+// called with the job whenever it is still running.
+app.waitForJob = function(jobId, callback, progress) {
+    $.getJSON('/job/' + jobId, function(job) {
+        if(job.state == 'running') {
+            if(progress) {
+                progress(job);
+            }
+            setTimeout(function() { app.waitForJob(jobId, callback, progress); }, 500);
+            return;
+        }
+        if(job.state == 'failed') {
+            console.log('Job ' + job.name + ' failed: ' + job.reason);
+        }
+        callback(job);
+    });
+};
+
 // ====================== Router ======================
 
 app.Router = Backbone.Router.extend({
@@ -66,7 +84,31 @@ app.Album = Backbone.Model.extend({
 
 app.Albums = Backbone.Collection.extend({
     url: '/query/',
-    model: app.Album
+    model: app.Album,
+    // Reload all albums of the collection using a single request.
+    refresh: function(callback) {
+        var albums = this;
+        if(albums.length == 0) {
+            if(callback) {
+                callback();
+            }
+            return;
+        }
+        var ids = albums.map(function(album) { return album.get('id'); });
+        // The ids are posted, a query may hold too many for an URL
+        $.post('/albums', {ids: ids.join(',')}, function(data) {
+            _.each(data, function(d) {
+                var album = albums.get(d.id);
+                if(album) {
+                    album.set(album.parse(d));
+                    album.trigger('sync', album, d);
+                }
+            });
+            if(callback) {
+                callback();
+            }
+        }, 'json');
+    }
 });
 
 // ====================== Views ======================
@@ -113,7 +155,10 @@ app.AlbumView = Backbone.View.extend({
             xhr.onload = function () {
                 if (xhr.status === 200) {
                     console.log('Image uploaded: ' + xhr.status);
-                    model.fetch();
+                    var response = JSON.parse(xhr.responseText);
+                    app.waitForJob(response.job, function() {
+                        model.fetch();
+                    });
                 } else {
                     console.log('Uploading image failed:' + xhr.status);
                 }
@@ -124,8 +169,14 @@ app.AlbumView = Backbone.View.extend({
             var url = e.originalEvent.dataTransfer.getData('text/uri-list');
             if (url != '') {
                 var model = this.model;
-                $.getJSON('/loadArt/' + this.model.get('id') + '/' + url, function() {
-                    model.fetch();
+                $.getJSON('/loadArt/' + this.model.get('id') + '/' + url, function(data) {
+                    if(data.result != 'ok') {
+                        console.log('Loading image failed: ' + data.reason);
+                        return;
+                    }
+                    app.waitForJob(data.job, function() {
+                        model.fetch();
+                    });
                 });
             }
         }
@@ -231,6 +282,7 @@ app.AppView = Backbone.View.extend({
         $('#artview').css('display', 'none');
     },
     initialize: function() {
+        this.albums = new app.Albums();
     },
     toggleHideOneArt: function () {
         $('#content').toggleClass('hideOneArt');
@@ -252,18 +304,29 @@ app.AppView = Backbone.View.extend({
         return query.split(/\s+/).map(encodeURIComponent).join('/');
     },
     acceptAll: function () {
-        var query = $('#query').val();
-        $.getJSON('/acceptArtQuery/' + this.getQueryUrl(), function() {
-            app.router.navigate('query/' + encodeURI(query), {trigger: true});
+        var albums = this.albums;
+        var label = $('#accept-all-label');
+        $.getJSON('/acceptArtQuery/' + this.getQueryUrl(), function(data) {
+            if(data.result != 'ok') {
+                console.log('Accepting art failed: ' + data.reason);
+                return;
+            }
+            app.waitForJob(data.job, function() {
+                label.text('Accept all');
+                albums.refresh();
+            }, function(job) {
+                label.text('Accepting ' + job.progress + '/' + job.total);
+            });
         });
     },
     collectAll: function () {
-        var query = $('#query').val();
+        var albums = this.albums;
         $.getJSON('/collectArtQuery/' + this.getQueryUrl(), function() {
-            app.router.navigate('query/' + encodeURI(query), {trigger: true});
+            albums.refresh();
         });
     },
     showAlbums: function(albums) {
+        this.albums = albums;
         $('#content').empty();
         albums.each(function(album) {
             var view = new app.AlbumView({model: album});
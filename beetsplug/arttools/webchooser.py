@@ -11,30 +11,93 @@
 #
 # The above copyright notice and this permission notice shall be
 # included in all copies or substantial portions of the Software.
+import gzip
+import hashlib
 import json
+import mimetypes
 import os
+import socket
+import threading
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 
 from flask import Flask, g, request
 import flask
+from PIL import Image
 import shutil
 import thread
+import time
+import uuid
 import requests
 from werkzeug.exceptions import abort
 from beets import config
+from beets.dbcore.query import OrQuery, MatchQuery
 from beets.util import bytestring_path, syspath
 
 from beetsplug.web import QueryConverter
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-app = Flask(__name__)
+
+# Static files are served by our own route (see send_static_file) to be able
+# to add fingerprints and precompressed variants.
+app = Flask(__name__, static_folder=None)
 app.url_map.converters['query'] = QueryConverter
 
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'static')
+# Fingerprinted static files never change, so they may be cached for a year.
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+# Only files of these types are worth compressing.
+COMPRESSIBLE_EXTENSIONS = ['.css', '.js', '.svg', '.ttf', '.eot', '.html']
+
+# Thumbnail sizes are clamped and rounded up to a multiple of the step to
+# keep the number of cached thumbnails per image small.
+THUMB_MIN_SIZE = 100
+THUMB_MAX_SIZE = 1000
+THUMB_SIZE_STEP = 100
+THUMB_QUALITY = 85
+
+# Loading art from remote hosts and storing uploads
+LOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_EXTENSIONS = {'JPEG': b'.jpg', 'PNG': b'.png', 'BMP': b'.bmp'}
+
+# Number of albums whose art is stored within one transaction when accepting
+# art for a query
+ACCEPT_BATCH_SIZE = 50
+
+# Number of finished background jobs which are remembered
+JOB_HISTORY = 100
+_jobs_lock = threading.Lock()
+
+# Maps the path of a static file to its (mtime, size), fingerprint and the
+# compressed variants of its content.
+_static_files = {}
+_static_files_lock = threading.Lock()
+
+# SQLite limits the number of host parameters per statement, so the batch
+# endpoint queries the ids in chunks of this size.
+ALBUM_ID_CHUNK_SIZE = 500
+
 
 def web_choose(plugin, lib, log, debug):
     app.config['lib'] = lib
     app.config['plugin'] = plugin
     app.config['log'] = log
     app.config['collect_tasks'] = []
+    app.config['jobs'] = {}
+    app.config['MAX_CONTENT_LENGTH'] = plugin.config['load_max_size'].get(int)
+    app.config['probe_pool'] = ThreadPool(
+        max(1, plugin.config['probe_threads'].get(int)))
+    app.use_x_sendfile = plugin.config['x_sendfile'].get(bool)
+    thumb_dir = plugin.config['thumb_cache_dir'].get()
+    if not thumb_dir:
+        thumb_dir = os.path.join(config.config_dir(), 'arttools_thumbs')
+    app.config['thumb_dir'] = bytestring_path(thumb_dir)
+    resume_pending_accepts()
     host = plugin.config['host'].get(unicode)
     port = plugin.config['port'].get(int)
     app.run(host=host, port=port, debug=debug, threaded=True)
@@ -46,6 +109,109 @@ def before_request():
     g.plugin = app.config['plugin']
     g.log = app.config['log']
     g.collect_tasks = app.config['collect_tasks']
+    g.jobs = app.config['jobs']
+    g.probe_pool = app.config['probe_pool']
+    g.thumb_dir = app.config['thumb_dir']
+
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    """Appends the fingerprint of static files to their URLs. This allows
+    the browser to cache them forever."""
+    if endpoint != 'static' or 'filename' not in values:
+        return
+    path = flask.safe_join(STATIC_FOLDER, values['filename'])
+    if path and os.path.isfile(path):
+        values['v'] = get_static_file(path)['fingerprint']
+
+
+def get_static_file(path):
+    """Returns the fingerprint and the precompressed variants of a static
+    file. They are computed only once per version of the file."""
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size)
+    with _static_files_lock:
+        static_file = _static_files.get(path)
+        if static_file and static_file['version'] == version:
+            return static_file
+
+    with open(path, 'rb') as f:
+        content = f.read()
+    variants = {}
+    if os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                           mtime=0) as gz:
+            gz.write(content)
+        variants['gzip'] = buf.getvalue()
+        if brotli:
+            variants['br'] = brotli.compress(content)
+    static_file = {'version': version,
+                   'fingerprint': hashlib.sha1(content).hexdigest()[:12],
+                   'variants': dict((encoding, data) for encoding, data
+                                    in variants.items()
+                                    if len(data) < len(content))}
+    with _static_files_lock:
+        _static_files[path] = static_file
+    return static_file
+
+
+@app.route("/static/<path:filename>", endpoint='static')
+def send_static_file(filename):
+    path = flask.safe_join(STATIC_FOLDER, filename)
+    if not path or not os.path.isfile(path):
+        abort(404)
+
+    static_file = get_static_file(path)
+    encoding = None
+    for candidate in ['br', 'gzip']:
+        if candidate in static_file['variants'] and \
+                candidate in request.accept_encodings:
+            encoding = candidate
+            break
+
+    if encoding:
+        mimetype = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        response = app.response_class(static_file['variants'][encoding],
+                                      mimetype=mimetype)
+        response.content_encoding = encoding
+        response.set_etag('{0}-{1}'.format(static_file['fingerprint'],
+                                           encoding))
+    else:
+        response = flask.send_file(path, add_etags=False, conditional=False)
+        response.set_etag(static_file['fingerprint'])
+    response.vary.add('Accept-Encoding')
+
+    if request.args.get('v') == static_file['fingerprint']:
+        response.headers['Cache-Control'] = \
+            'public, max-age={0}, immutable'.format(STATIC_MAX_AGE)
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def send_art_file(path):
+    """Sends an image file. The file is sent using the file wrapper of the
+    server (or X-Sendfile, if enabled), so it is not copied to user space.
+    The response carries a strong ETag derived from the modification time
+    and the size of the file and supports conditional and range requests."""
+    path = syspath(path)
+    if not os.path.isfile(path):
+        abort(404)
+    stat = os.stat(path)
+
+    response = flask.send_file(path, add_etags=False, conditional=False,
+                               cache_timeout=0)
+    response.set_etag('{0:x}-{1:x}'.format(int(stat.st_mtime * 1000),
+                                           stat.st_size))
+    response.last_modified = int(stat.st_mtime)
+    # Art files may be replaced (e.g. by uploads), so let the browser
+    # revalidate them. Unchanged files are answered by 304 Not Modified.
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = 0
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=stat.st_size)
 
 
 @app.route("/")
@@ -81,14 +247,119 @@ def get_album_json(album_id):
     return json.dumps(get_album_dict(album))
 
 
+@app.route("/albums", methods=['post'])
+def get_albums_json():
+    """Returns the dicts of all albums given as a comma separated list of
+    ids in the form field ids. The ids are posted since a query may hold
+    more albums than fit into an URL. The albums are fetched using a single
+    query per chunk of ids and their images are probed in parallel. The
+    result keeps the order of the requested ids; unknown ids are left out.
+    """
+    try:
+        ids = [int(album_id)
+               for album_id in request.form.get('ids', '').split(',')
+               if album_id]
+    except ValueError:
+        abort(400)
+
+    albums = get_albums_by_ids(g.lib, ids)
+
+    plugin = g.plugin
+    collect_tasks = g.collect_tasks
+    result = g.probe_pool.map(
+        lambda a: build_album_dict(a, plugin, collect_tasks), albums)
+
+    return json.dumps(result)
+
+
 @app.route("/art/<album_id>/<file_name>")
 def get_art_file(album_id, file_name):
     file_name = bytestring_path(file_name)
     if os.sep in file_name:
         abort(404)
     album = g.lib.albums(u"id:" + album_id).get()
+    if not album:
+        abort(404)
+
+    return send_art_file(os.path.join(album.path, file_name))
+
+
+@app.route("/thumb/<album_id>/<file_name>")
+def get_thumb_file(album_id, file_name):
+    file_name = bytestring_path(file_name)
+    if os.sep in file_name:
+        abort(404)
+    album = g.lib.albums(u"id:" + album_id).get()
+    if not album:
+        abort(404)
+
+    try:
+        size = int(request.args.get('size', THUMB_MIN_SIZE))
+    except ValueError:
+        abort(404)
+
+    art_path = syspath(os.path.join(album.path, file_name))
+    if not os.path.isfile(art_path):
+        abort(404)
+    try:
+        thumb_path = get_thumbnail(art_path, size, g.thumb_dir,
+                                   g.plugin.config['thumb_format'].get(
+                                       unicode))
+    except IOError:
+        abort(404)
 
-    return flask.send_file(syspath(os.path.join(album.path, file_name)))
+    return send_art_file(thumb_path)
+
+
+def get_albums_by_ids(lib, ids):
+    """Fetches the albums with the given ids using one query per chunk of
+    ids. The result keeps the order of the ids; unknown ids are left out."""
+    albums = {}
+    for start in range(0, len(ids), ALBUM_ID_CHUNK_SIZE):
+        chunk = ids[start:start + ALBUM_ID_CHUNK_SIZE]
+        query = OrQuery([MatchQuery('id', album_id) for album_id in chunk])
+        for album in lib.albums(query):
+            albums[album.id] = album
+    return [albums[album_id] for album_id in ids if album_id in albums]
+
+
+def get_thumbnail(path, size, thumb_dir, thumb_format=u'jpeg'):
+    """Returns the path of a downscaled copy of the image at the given path
+    which fits into a square of the given size. Thumbnails are cached in
+    thumb_dir; the cache key includes the modification time and size of the
+    image, so changed images get a new thumbnail."""
+    size = min(max(size, THUMB_MIN_SIZE), THUMB_MAX_SIZE)
+    size = -(-size // THUMB_SIZE_STEP) * THUMB_SIZE_STEP
+    stat = os.stat(path)
+    key = hashlib.sha1(b'{0}:{1}:{2}:{3}'.format(
+        path, stat.st_mtime, stat.st_size, size)).hexdigest()
+    ext, pil_format = (b'.webp', 'WEBP') if thumb_format == u'webp' \
+        else (b'.jpg', 'JPEG')
+    thumb_path = os.path.join(thumb_dir, key[:2], key + ext)
+    if os.path.isfile(thumb_path):
+        return thumb_path
+
+    im = Image.open(path)
+    # Let the decoder do the downscaling (JPEG only). This is much faster and
+    # needs less memory than decoding the image at full size.
+    im.draft('RGB', (size, size))
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    im.thumbnail((size, size), Image.ANTIALIAS)
+
+    if not os.path.isdir(os.path.dirname(thumb_path)):
+        try:
+            os.makedirs(os.path.dirname(thumb_path))
+        except OSError:
+            # Created by a concurrent request
+            pass
+    # Write to a temporary file first, so concurrent requests never send a
+    # partly written thumbnail.
+    tmp_path = b'{0}.{1}.tmp'.format(thumb_path,
+                                     threading.current_thread().ident)
+    im.save(tmp_path, pil_format, quality=THUMB_QUALITY)
+    os.rename(tmp_path, thumb_path)
+    return thumb_path
 
 
 @app.route("/deleteArt/<album_id>/<file_name>")
@@ -111,6 +382,12 @@ def delete_art_file(album_id, file_name):
 
 
 def set_art(album, art_path):
+    bind_art(album, art_path)
+    # Delete other files
+    g.plugin.delete_unused_art_of_album(album)
+
+
+def bind_art(album, art_path):
     # Set new cover art
     art_filename = bytestring_path(config["art_filename"].get())
     new_image = syspath(os.path.join(album.item_dir(), art_filename +
@@ -120,8 +397,6 @@ def set_art(album, art_path):
         shutil.copy(art_path, new_image)
     album.set_art(new_image, copy=False)
     album.store()
-    # Delete other files
-    g.plugin.delete_unused_art_of_album(album)
 
 
 @app.route("/chooseArt/<album_id>/<file_name>")
@@ -150,17 +425,93 @@ def accept_art_no_query():
 
 @app.route("/acceptArtQuery/<query:queries>")
 def accept_art_query(queries):
-    albums = g.lib.albums(queries)
-
-    for album in albums:
-        accept_art_for_album(album)
-
-    return json.dumps({'result': 'ok'})
-
-
-def accept_art_for_album(album):
-    chosen_art = bytestring_path(g.plugin.get_chosen_art(album))
-    set_art(album, chosen_art)
+    album_ids = [album.id for album in g.lib.albums(queries)]
+    job = start_accept_job(album_ids)
+    if job is None:
+        return json.dumps({'result': 'failed',
+                           'reason': 'Already accepting art.'})
+
+    return json.dumps({'result': 'ok', 'job': job['id']})
+
+
+def start_accept_job(album_ids):
+    """Starts a background job which binds the chosen art to all albums
+    given. The albums are handled in batches: the art is chosen in parallel
+    and all albums of a batch are stored within a single transaction. The
+    ids of the albums not handled yet are kept in the state file, so an
+    interrupted job can be resumed (see resume_pending_accepts). Only one
+    accept job runs at a time since they share the state file; returns None
+    if another one is running."""
+    lib = app.config['lib']
+    plugin = app.config['plugin']
+    pool = app.config['probe_pool']
+    log = app.config['log']
+
+    def accept(job):
+        pending = list(album_ids)
+        save_pending_accepts(pending)
+        job['total'] = len(pending)
+        while pending:
+            batch = pending[:ACCEPT_BATCH_SIZE]
+            albums = get_albums_by_ids(lib, batch)
+            chosen_arts = pool.map(plugin.get_chosen_art, albums)
+            accepted = []
+            with lib.transaction():
+                for album, chosen_art in zip(albums, chosen_arts):
+                    if not chosen_art:
+                        continue
+                    bind_art(album, bytestring_path(chosen_art))
+                    accepted.append(album)
+            # Only delete files after the new art is committed
+            for album in accepted:
+                plugin.delete_unused_art_of_album(album)
+
+            pending = pending[len(batch):]
+            save_pending_accepts(pending)
+            job['progress'] += len(batch)
+        log.info(u'Accepted art for {0} albums', job['total'])
+
+    return start_job(u'accept', accept, exclusive=True)
+
+
+def get_accept_state_path():
+    path = app.config['plugin'].config['accept_state_file'].get()
+    if not path:
+        path = os.path.join(config.config_dir(), 'arttools_accept.json')
+    return path
+
+
+def save_pending_accepts(album_ids):
+    """Stores the ids of the albums whose art is still to be accepted."""
+    path = get_accept_state_path()
+    if not album_ids:
+        if os.path.isfile(path):
+            os.remove(path)
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(album_ids, f)
+    if os.path.isfile(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def resume_pending_accepts():
+    """Restarts accepting art for the albums left over by an interrupted
+    acceptArtQuery job."""
+    path = get_accept_state_path()
+    if not os.path.isfile(path):
+        return
+    try:
+        with open(path) as f:
+            album_ids = json.load(f)
+    except ValueError:
+        app.config['log'].warn(u'Ignoring corrupt state file {0}', path)
+        return
+    if album_ids:
+        app.config['log'].info(u'Resuming to accept art for {0} albums',
+                               len(album_ids))
+        start_accept_job(album_ids)
 
 
 @app.route("/collectArt/<album_id>")
@@ -218,13 +569,15 @@ def upload_art(album_id):
     if len(request.files) != 1:
         abort(404)
 
-    uploaded_file = request.files['file']
-    ext = os.path.splitext(uploaded_file.filename)[1]
-    file_name = b"uploaded{0}".format(ext)
-    file_path = os.path.join(album.path, file_name)
-    uploaded_file.save(file_path)
+    # Only spool the upload into the album folder here. Validating and
+    # storing it is done by a background job.
+    album_path = syspath(album.path)
+    tmp_path = get_part_file_path(album_path)
+    request.files['file'].save(tmp_path, buffer_size=LOAD_CHUNK_SIZE)
+    job = start_job(u'upload', lambda job: store_uploaded_art(tmp_path,
+                                                              album_path))
 
-    return "Saved"
+    return json.dumps({'result': 'ok', 'job': job['id']})
 
 
 @app.route("/loadArt/<album_id>/<path:art_url>")
@@ -235,34 +588,205 @@ def load_art(album_id, art_url):
 
     if art_url is None or art_url == '':
         abort(404)
-
-    r = requests.get(art_url, stream=True)
-    if r.status_code == requests.codes.ok:
-        ext = os.path.splitext(art_url)[1]
-        if ext == '':
-            return json.dumps({'result': 'failed',
-                               'reason': 'Unable to determine image format.'})
-        file_name = b"uploaded{0}".format(ext)
-        file_path = os.path.join(album.path, file_name)
-        with open(file_path, 'wb') as f:
-            for chunk in r.iter_content(1024):
+    if not art_url.startswith(('http://', 'https://')):
+        return json.dumps({'result': 'failed',
+                           'reason': 'Only http and https URLs are '
+                                     'supported.'})
+
+    album_path = syspath(album.path)
+    max_size = g.plugin.config['load_max_size'].get(int)
+    timeout = g.plugin.config['load_timeout'].get(float)
+    job = start_job(u'load', lambda job: download_art(art_url, album_path,
+                                                      max_size, timeout))
+
+    return json.dumps({'result': 'ok', 'job': job['id']})
+
+
+class ArtLoadError(Exception):
+    pass
+
+
+def get_part_file_path(album_path):
+    """Returns the path of a new temporary file in the album folder. The name
+    does not match any art name, so it is never listed as art."""
+    return os.path.join(album_path,
+                        b'.uploaded.{0}.part'.format(uuid.uuid4().hex))
+
+
+def download_art(url, album_path, max_size, timeout,
+                 chunk_size=LOAD_CHUNK_SIZE):
+    """Downloads an image and stores it as uploaded art of the album at
+    album_path. Raises an ArtLoadError if the download takes more than
+    timeout seconds in total, the image is larger than max_size bytes or
+    it is not an image at all. Returns the name of the stored file."""
+    start = time.time()
+    tmp_path = get_part_file_path(album_path)
+    try:
+        r = requests.get(url, stream=True, timeout=timeout)
+    except requests.RequestException as e:
+        raise ArtLoadError(u'Unable to load {0}: {1}'.format(url, e))
+
+    # The timeout of requests applies to each read of the socket only, so a
+    # host sending a byte every few seconds would never time out. The
+    # connection is closed when the time is up instead.
+    timed_out = threading.Event()
+    timer = threading.Timer(max(timeout - (time.time() - start), 0),
+                            abort_response, [r, timed_out])
+    timer.daemon = True
+    timer.start()
+    try:
+        if r.status_code != requests.codes.ok:
+            raise ArtLoadError(u'Unable to load {0}: HTTP status {1}'.format(
+                url, r.status_code))
+        content_length = r.headers.get('content-length')
+        if content_length and int(content_length) > max_size:
+            raise ArtLoadError(u'Image is too large ({0} bytes).'.format(
+                content_length))
+
+        size = 0
+        with open(tmp_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise ArtLoadError(u'Image is too large (more than {0} '
+                                       u'bytes).'.format(max_size))
+                if timed_out.is_set():
+                    break
                 f.write(chunk)
+        if timed_out.is_set():
+            raise ArtLoadError(u'Loading the image took more than {0} '
+                               u'seconds.'.format(timeout))
+    except Exception as e:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        if timed_out.is_set() and not isinstance(e, ArtLoadError):
+            raise ArtLoadError(u'Loading the image took more than {0} '
+                               u'seconds.'.format(timeout))
+        if isinstance(e, requests.RequestException):
+            raise ArtLoadError(u'Unable to load {0}: {1}'.format(url, e))
+        raise
+    finally:
+        timer.cancel()
+        r.close()
+
+    return store_uploaded_art(tmp_path, album_path)
+
+
+def abort_response(r, timed_out):
+    """Interrupts a streamed response, even while a read is blocking."""
+    timed_out.set()
+    # Closing the response does not wake up a thread blocked reading the
+    # socket, shutting the socket down does.
+    fp = getattr(getattr(r.raw, '_fp', None), 'fp', None)
+    sock = getattr(fp, '_sock', None) or \
+        getattr(getattr(fp, 'raw', None), '_sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, AttributeError):
+            pass
+    r.close()
 
-    return json.dumps({'result': 'ok'})
+
+def store_uploaded_art(tmp_path, album_path):
+    """Checks if the file at tmp_path is an image and moves it to the album
+    folder using the name of uploaded art. The extension is derived from
+    the image format. Returns the name of the stored file."""
+    try:
+        try:
+            im = Image.open(tmp_path)
+            im.verify()
+        except Exception:
+            raise ArtLoadError(u'The file is not an image.')
+        ext = UPLOAD_EXTENSIONS.get(im.format)
+        if not ext:
+            raise ArtLoadError(u'Unsupported image format {0}.'.format(
+                im.format))
+
+        file_name = b'uploaded{0}'.format(ext)
+        file_path = os.path.join(album_path, file_name)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+        os.rename(tmp_path, file_path)
+        return file_name
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def start_job(name, target, exclusive=False):
+    """Runs target in a background thread. target gets the dict describing
+    the job and may update its progress. Returns the job dict; its state
+    can be queried using the /job route. An exclusive job is not started
+    (and None is returned) while another job of the same name is running.
+    """
+    jobs = app.config['jobs']
+    log = app.config['log']
+    with _jobs_lock:
+        if exclusive and any(j['name'] == name and j['state'] == 'running'
+                             for j in jobs.values()):
+            return None
+
+        # Forget the oldest finished jobs
+        finished = sorted((j for j in jobs.values()
+                           if j['state'] != 'running'),
+                          key=lambda j: j['started'])
+        for job in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del jobs[job['id']]
+
+        job = {'id': uuid.uuid4().hex,
+               'name': name,
+               'state': 'running',
+               'started': time.time(),
+               'progress': 0,
+               'total': 0,
+               'result': None,
+               'reason': None}
+        jobs[job['id']] = job
+
+    def run():
+        try:
+            job['result'] = target(job)
+            job['state'] = 'done'
+        except ArtLoadError as e:
+            job['reason'] = unicode(e)
+            job['state'] = 'failed'
+        except Exception as e:
+            log.error(u'Job {0} failed: {1}', name, e)
+            job['reason'] = unicode(e)
+            job['state'] = 'failed'
+
+    thread.start_new_thread(run, ())
+    return job
+
+
+@app.route("/job/<job_id>")
+def get_job(job_id):
+    job = g.jobs.get(job_id)
+    if not job:
+        abort(404)
+
+    return json.dumps(job)
 
 
 def get_album_dict(album):
+    return build_album_dict(album, g.plugin, g.collect_tasks)
+
+
+def build_album_dict(album, plugin, collect_tasks):
+    """Creates the dict sent to the client for a single album. Does not
+    use the request context so it can be called from worker threads."""
     art_files = []
     bound_art = None
     if album.artpath:
         bound_art = os.path.split(album.artpath)[1]
-    chosen_art = g.plugin.get_chosen_art(album)
+    chosen_art = plugin.get_chosen_art(album)
     if chosen_art:
         chosen_art = os.path.split(chosen_art)[1]
-    for art_file in g.plugin.get_art_files(album.path):
+    for art_file in plugin.get_art_files(album.path):
         try:
             width, height, _, aspect_ratio, file_size = \
-                g.plugin.get_image_info(art_file)
+                plugin.get_image_info(art_file)
         except IOError:
             continue
         file_name = os.path.split(art_file)[1]
@@ -276,5 +800,5 @@ def get_album_dict(album):
     album_dict = {'id': album.id,
                   'title': str(album),
                   'art_files': art_files,
-                  'collecting': album.id in g.collect_tasks}
+                  'collecting': album.id in collect_tasks}
     return album_dict
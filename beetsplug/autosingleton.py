@@ -11,14 +11,116 @@
 #
 # The above copyright notice and this permission notice shall be
 # included in all copies or substantial portions of the Software.
+import fnmatch
 import os
 import re
 
-from beets import util, config
+from beets import util, config, ui
 from beets.importer import ImportTask, SingletonImportTask,\
-    SentinelImportTask, ArchiveImportTask, ImportTaskFactory
+    SentinelImportTask, ArchiveImportTask, albums_in_dir
+from beets.library import Item, ReadError
 from beets.plugins import BeetsPlugin
-from beets.util import fnmatch_all
+from beets.ui import Subcommand
+from beets.util import confit
+
+from beetsplug import dircache
+
+# File names of album tracks start with the track number
+TRACK_NUMBER = re.compile('\\d\\d+ - ', re.IGNORECASE)
+
+# A condition is a feature value optionally prefixed by a comparison operator
+CONDITION = re.compile(r'^\s*(>=|<=|!=|>|<|=)?\s*(.*?)\s*$')
+
+# The rules reproducing the original heuristics: a folder named misc, a
+# folder with subdirectories that are not clutter or a folder with mp3 files
+# not starting with a track number contains singletons.
+DEFAULT_RULES = [
+    {'folder_name': 'misc'},
+    {'subdirs': '>0'},
+    {'unnumbered_mp3': '>0'},
+]
+
+
+def directory_features(path, items, subdirs):
+    """Computes the features of a directory used by the classifier rules.
+
+    :param path: The path of the directory.
+    :param items: The items read from the files of the directory.
+    :param subdirs: The names of the subdirectories that are not clutter.
+    """
+    _, folder = os.path.split(util.syspath(path))
+    features = {
+        'folder_name': util.displayable_path(folder).lower(),
+        'subdirs': len(subdirs),
+        'files': len(items),
+        'numbered': 0,
+        'unnumbered_mp3': 0,
+    }
+    albums = set()
+    artists = set()
+    for item in items:
+        _, file_name = os.path.split(util.syspath(item['path']))
+        numbered = TRACK_NUMBER.match(file_name) is not None
+        if numbered:
+            features['numbered'] += 1
+        elif file_name.endswith('.mp3'):
+            features['unnumbered_mp3'] += 1
+        _, ext = os.path.splitext(file_name)
+        key = 'ext_' + util.displayable_path(ext[1:]).lower()
+        features[key] = features.get(key, 0) + 1
+        albums.add(item['album'])
+        artists.add(item['albumartist'] or item['artist'])
+    features['numbered_ratio'] = \
+        float(features['numbered']) / len(items) if items else 0.0
+    features['albums'] = len(albums)
+    features['artists'] = len(artists)
+    return features
+
+
+class ClassifierRule(object):
+    """A rule classifying a directory as singletons if all of its
+    conditions hold. A condition compares a feature like ``subdirs`` with a
+    value like ``'>0'``. Missing features are 0.
+    """
+    def __init__(self, conditions):
+        self.conditions = []
+        for feature, condition in sorted(conditions.items()):
+            op, value = CONDITION.match(unicode(condition)).groups()
+            if op:
+                value = float(value)
+            self.conditions.append((feature, op or '=', value))
+        self.source = conditions
+
+    @classmethod
+    def from_config(cls, rule_config):
+        if not isinstance(rule_config, dict) or not rule_config:
+            raise ValueError(u'invalid rule {0!r}'.format(rule_config))
+        try:
+            return cls(rule_config)
+        except ValueError:
+            raise ValueError(u'invalid rule {0!r}'.format(rule_config))
+
+    def matches(self, features):
+        for feature, op, value in self.conditions:
+            actual = features.get(feature, 0)
+            if isinstance(value, float):
+                result = {'=': actual == value, '!=': actual != value,
+                          '>': actual > value, '>=': actual >= value,
+                          '<': actual < value, '<=': actual <= value}[op]
+            elif isinstance(actual, basestring):
+                result = actual == value.lower()
+            else:
+                try:
+                    result = actual == float(value)
+                except ValueError:
+                    result = False
+            if not result:
+                return False
+        return True
+
+    def __str__(self):
+        return ', '.join(u'{0} {1} {2}'.format(feature, op, value)
+                         for feature, op, value in self.conditions)
 
 
 class AutoSingletonPlugin(BeetsPlugin):
@@ -27,11 +129,64 @@ class AutoSingletonPlugin(BeetsPlugin):
 
         self.chained = False
 
-        self.config.add({'clutter_dirs': []})
+        self.config.add({
+            'clutter_dirs': [],
+            'rules': DEFAULT_RULES
+        })
+        self.rules = self.get_rules()
+
+        # Compiled clutter patterns and the patterns they were compiled from
+        self.clutter_patterns = None
+        self.clutter_regex = None
+
+        # The relevant subdirectories of each directory and its mtime when
+        # they were listed
+        self.subdir_cache = {}
 
         self.register_listener('import_task_created',
                                self.import_task_created_event)
 
+    def get_rules(self):
+        """Reads the classifier rules from the config. Invalid rules are
+        reported as a configuration error."""
+        rules_config = self.config['rules']
+        try:
+            return [ClassifierRule.from_config(rule)
+                    for rule in rules_config.get(list)]
+        except ValueError as exc:
+            raise confit.ConfigError(u'{0}: {1}'.format(rules_config.name,
+                                                        exc))
+
+    def commands(self):
+        classify_command = Subcommand('autosingleton',
+                                      help='shows which folders would be '
+                                           'imported as singletons')
+        classify_command.func = self.classify_command
+        return [classify_command]
+
+    def classify_command(self, lib, opts, args):
+        """Classifies all folders below the given paths like an import
+        would, without importing anything.
+        """
+        cache = dircache.DirectoryCache()
+        for path in ui.decargs(args):
+            for dirs, paths in albums_in_dir(util.normpath(path)):
+                items = []
+                for item_path in paths:
+                    try:
+                        items.append(Item.from_path(item_path))
+                    except ReadError:
+                        pass
+                if not items:
+                    continue
+                rule = self.classify(dirs[0], items, cache)
+                if rule:
+                    ui.print_(u'singletons {0} ({1})'.format(
+                        util.displayable_path(dirs[0]), rule))
+                else:
+                    ui.print_(u'album      {0}'.format(
+                        util.displayable_path(dirs[0])))
+
     def import_task_created_event(self, session, task, chained=False):
         """
 
@@ -45,43 +200,76 @@ class AutoSingletonPlugin(BeetsPlugin):
                 or isinstance(task, ArchiveImportTask):
             return [task]
 
-        if self.is_singleton(task):
+        if self.is_singleton(task, session):
             return self.get_singletons(task, session)
         return [task]
 
     @staticmethod
     def get_singletons(task, session):
-        factory = ImportTaskFactory(task.toppath, session)
+        """Creates a singleton task for every item of the task. The items
+        have already been read, so the files are not read again.
+        """
         new_tasks = []
         for item in task.items:
-            new_task = factory.singleton(item.path)
-            if new_task:
-                new_tasks.append(new_task)
+            if session.already_imported(task.toppath, [item.path]):
+                continue
+            new_tasks.append(SingletonImportTask(task.toppath, item))
 
         return new_tasks
 
-    def is_singleton(self, task):
-        task_path = util.syspath(task.paths[0])
-        path, folder = os.path.split(task_path)
-        if folder.lower() == 'misc':
-            # Singletons
-            return True
-
-        # Are there any directories in the folder of the current task?
-        clutter = config['clutter'].as_str_seq()
-        for sub_entry in os.listdir(task_path):
-            full_sub_entry = os.path.join(task_path, sub_entry)
-            if os.path.isdir(full_sub_entry) and not fnmatch_all([sub_entry], clutter):
-                # Singletons
-                return True
-
-        # Do any of the file names of all items does not start with two digits?
-        pattern = re.compile('\\d\\d+ - ', re.IGNORECASE)
-        for path in [util.syspath(item['path']) for item in task.items]:
-            _, file_name = os.path.split(path)
-            if path.endswith('.mp3') and not pattern.match(file_name):
-                # Singleton
-                return True
-
-        # Album
-        return False
+    def get_clutter_regex(self):
+        """Returns a regex matching the names of clutter directories. It is
+        only recompiled if the clutter option changed.
+        """
+        patterns = config['clutter'].as_str_seq()
+        if patterns != self.clutter_patterns:
+            self.clutter_patterns = patterns
+            self.subdir_cache = {}
+            self.clutter_regex = re.compile(u'|'.join(
+                u'(?:{0})'.format(fnmatch.translate(pattern))
+                for pattern in patterns) or u'(?!)')
+        return self.clutter_regex
+
+    def get_subdirs(self, path, cache):
+        """Returns the names of the subdirectories of path that are not
+        clutter. They are listed once and cached until the mtime of the
+        directory changes.
+        """
+        stat = cache.stat(path)
+        mtime = stat.st_mtime if stat else None
+        cached = self.subdir_cache.get(path)
+        if cached and mtime is not None and cached[0] == mtime:
+            return cached[1]
+
+        clutter = self.get_clutter_regex()
+        subdirs = [name for name in cache.subdirectories(path)
+                   if not clutter.match(os.path.normcase(
+                       util.displayable_path(name)))]
+        self.subdir_cache[path] = (mtime, subdirs)
+        return subdirs
+
+    def get_features(self, path, items, cache):
+        """Returns the features of the directory. The items differ between
+        the tasks of a directory (e.g. after another plugin removed some),
+        so only the subdirectories are cached.
+        """
+        return directory_features(path, items, self.get_subdirs(path, cache))
+
+    def classify(self, path, items, cache):
+        """Returns the first rule classifying the directory as singletons or
+        None if it contains an album.
+        """
+        features = self.get_features(path, items, cache)
+        for rule in self.rules:
+            if rule.matches(features):
+                self._log.debug(u'{0} contains singletons: {1}',
+                                util.displayable_path(path), rule)
+                return rule
+        return None
+
+    def is_singleton(self, task, session=None):
+        if session is None:
+            cache = dircache.DirectoryCache()
+        else:
+            cache = dircache.for_session(session)
+        return self.classify(task.paths[0], task.items, cache) is not None
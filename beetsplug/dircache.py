@@ -0,0 +1,141 @@
+# This file is part of beets.
+# Copyright 2016, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+"""A file system metadata cache shared by the plugins of an import session.
+This is not a plugin itself.
+"""
+import os
+import stat
+import weakref
+
+from beets.util import bytestring_path, syspath
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+_session_caches = weakref.WeakKeyDictionary()
+
+
+def for_session(session):
+    """Returns the directory cache of the given import session. All plugins
+    asking for the cache of the same session share it.
+    """
+    cache = _session_caches.get(session)
+    if cache is None:
+        cache = DirectoryCache()
+        _session_caches[session] = cache
+    return cache
+
+
+def invalidate(session):
+    """Drops the cache of the session and returns it, or None if the
+    session had none."""
+    return _session_caches.pop(session, None)
+
+
+def db_path(value):
+    """Converts a path or path component read from the library database to
+    a byte string. Paths are stored as blobs; very old libraries may contain
+    text.
+    """
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        return bytestring_path(value)
+    return bytes(value)
+
+
+class DirectoryCache(object):
+    """Lists and stats every directory and file only once. The type of the
+    entries is taken from scandir if available, so no additional stat calls
+    are needed.
+    """
+    def __init__(self):
+        self.directories = {}
+        self.stats = {}
+        self.splits = {}
+        self.hits = 0
+        self.misses = 0
+
+    def entries(self, path):
+        """Returns a list of (name, is_dir) tuples for the entries of the
+        directory path. Unreadable directories have no entries.
+        """
+        entries = self.directories.get(path)
+        if entries is not None:
+            self.hits += 1
+            return entries
+        self.misses += 1
+        try:
+            if scandir:
+                entries = [(entry.name, entry.is_dir())
+                           for entry in scandir(syspath(path))]
+            else:
+                entries = [(name, os.path.isdir(syspath(
+                    os.path.join(path, name))))
+                    for name in os.listdir(syspath(path))]
+        except OSError:
+            entries = []
+        self.directories[path] = entries
+        return entries
+
+    def subdirectories(self, path):
+        """Returns the names of the directories inside path."""
+        return [name for name, is_dir in self.entries(path) if is_dir]
+
+    def stat(self, path):
+        """Returns the stat result of path or None if it does not exist."""
+        if path in self.stats:
+            self.hits += 1
+            return self.stats[path]
+        self.misses += 1
+        try:
+            result = os.stat(syspath(path))
+        except OSError:
+            result = None
+        self.stats[path] = result
+        return result
+
+    def is_dir(self, path):
+        result = self.stat(path)
+        return result is not None and stat.S_ISDIR(result.st_mode)
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def entry_stats(self, path):
+        """Returns a list of (name, stat) tuples for the entries of the
+        directory path. The stat is None for entries removed meanwhile.
+        """
+        return [(name, self.stat(os.path.join(path, name)))
+                for name, _ in self.entries(path)]
+
+    def split(self, path, split_path):
+        """Returns split_path(path), computed once per path."""
+        components = self.splits.get(path)
+        if components is not None:
+            self.hits += 1
+            return components
+        self.misses += 1
+        components = self.splits[path] = split_path(path)
+        return components
+
+    def clear(self):
+        self.directories.clear()
+        self.stats.clear()
+        self.splits.clear()
@@ -14,57 +14,373 @@
 
 import os
 import sys
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+from beets import ui
+from beets.dbcore.query import FieldQuery
 from beets.importer import SingletonImportTask
+from beets.library import Album, Item, parse_query_parts
 from beets.plugins import BeetsPlugin
+from beets.ui import Subcommand
+
+from beetsplug import dircache
+
+# Number of items read, computed and written together by the dirfields
+# command
+BACKFILL_CHUNK_SIZE = 1000
+
+# Prefixes of queries using the index, e.g. dir3:@Vinyl for items and
+# dir3:%Vinyl for albums (beet ls -a). beets does not tell a prefix query
+# which model it is for, so each model has its own prefix.
+INDEX_QUERY_PREFIX = '@'
+ALBUM_INDEX_QUERY_PREFIX = '%'
+
+
+def parse_levels(levels_config):
+    """Parses the levels option into a set of levels and the level from
+    which on all levels are used. Without any level, all levels are used.
+    """
+    highest_level = sys.maxint
+    levels = set()
+    if levels_config:
+        level_split = str(levels_config).split(',')
+        for level_config in level_split:
+            level_config = level_config.replace(' ', '')
+            if len(level_config) == 0:
+                continue
+            if '-' in level_config:
+                if level_config[-1] == '-':
+                    highest_level = int(level_config[:-1])
+                else:
+                    start_level = 0
+                    if level_config[0] != '-':
+                        start_level = int(level_config[0:level_config.index('-')])
+                    end_level = int(level_config[level_config.index('-') + 1:])
+                    if end_level < start_level:
+                        start_level, end_level = end_level, start_level
+                    levels.update(range(start_level, end_level + 1))
+            else:
+                levels.add(int(level_config))
+    if len(levels) == 0:
+        highest_level = 0
+    return frozenset(levels), highest_level
+
+
+def split_path(path):
+    """Splits a path into all of its components, starting with the root."""
+    path = os.path.normpath(path)
+    dirs = []
+    while path and len(path) > 0:
+        path, file_system_object = os.path.split(path)
+        if not file_system_object or len(file_system_object) == 0:
+            file_system_object = path.replace(os.path.sep, '')
+            path = ''
+        dirs.append(file_system_object)
+    dirs.reverse()
+    return dirs
+
+
+def dir_fields(dirs, levels, highest_level, field_name):
+    """Returns the fields for the path components in dirs.
+
+    :param levels: The set of levels to use.
+    :param highest_level: All levels starting from this one are used.
+    :param field_name: A function returning the field name of a level.
+    """
+    return dict((field_name(idx), dir_name)
+                for idx, dir_name in enumerate(dirs)
+                if idx >= highest_level or idx in levels)
+
+
+def path_fields(path, levels, highest_level, names):
+    """Returns the fields of an item path. Unlike dir_fields, this only
+    takes picklable arguments so it can run in a worker process.
+
+    :param names: Maps levels to renamed field names.
+    """
+    return dir_fields(split_path(path), levels, highest_level,
+                      lambda idx: names.get(idx, 'dir%i' % idx))
+
+
+class DirFieldQuery(FieldQuery):
+    """Matches items by the name of a directory of their path using the
+    dirfields_index table. The field is a field written by the plugin, e.g.
+    dir3 or a renamed one. Other fields match the name at any level.
+    The query is for items only; albums are matched by AlbumDirFieldQuery.
+    """
+    # Maps renamed fields to their levels; set by the plugin
+    field_levels = {}
+    # The model whose ids the clause selects
+    model_cls = Item
+
+    @classmethod
+    def level(cls, field):
+        """Returns the level of a field or None if it is no dirfields
+        field."""
+        level = cls.field_levels.get(field)
+        if level is None and field.startswith('dir') and field[3:].isdigit() \
+                and int(field[3:]) not in cls.field_levels.values():
+            level = int(field[3:])
+        return level
+
+    def clause(self):
+        sql = 'SELECT item_id FROM dirfields_index WHERE name = ?'
+        subvals = [self.pattern]
+        level = self.level(self.field)
+        if level is not None:
+            sql += ' AND level = ?'
+            subvals.append(level)
+        if issubclass(self.model_cls, Album):
+            sql = 'SELECT album_id FROM items WHERE id IN ({0})'.format(sql)
+        return 'id IN ({0})'.format(sql), subvals
+
+    def match(self, obj):
+        # Used if the query is combined with a slow one. The index is
+        # looked up like the clause does, so both give the same result.
+        if obj._db is None or obj.id is None:
+            return False
+        clause, subvals = self.clause()
+        with obj._db.transaction() as tx:
+            rows = tx.query('SELECT 1 FROM {0} WHERE id = ? AND {1}'.format(
+                obj._table, clause), [obj.id] + subvals)
+        return bool(rows)
+
+
+class AlbumDirFieldQuery(DirFieldQuery):
+    """Matches albums having an item matched by DirFieldQuery."""
+    model_cls = Album
 
 
 class DirFieldsPlugin(BeetsPlugin):
     def __init__(self):
         super(DirFieldsPlugin, self).__init__()
         self.import_stages = [self.stage]
+        self.config.add({'index': False})
 
-    def stage(self, config, task):
-        highest_level = sys.maxint
-        levels = []
-        if 'levels' in self.config and self.config['levels'].get():
-            level_split = str(self.config['levels'].get()).split(',')
-            for level_config in level_split:
-                level_config = level_config.replace(' ', '')
-                if len(level_config) == 0:
-                    continue
-                if '-' in level_config:
-                    if level_config[-1] == '-':
-                        highest_level = int(level_config[:-1])
-                    else:
-                        start_level = 0
-                        if level_config[0] != '-':
-                            start_level = int(level_config[0:level_config.index('-')])
-                        end_level = int(level_config[level_config.index('-') + 1:])
-                        if end_level < start_level:
-                            start_level, end_level = end_level, start_level
-                        for idx in range(start_level, end_level + 1):
-                            levels.append(idx)
-                else:
-                    levels.append(int(level_config))
-        if len(levels) == 0:
-            highest_level = 0
+        self.index = self.config['index'].get(bool)
+        if self.index:
+            self.register_listener('library_opened', self.create_index)
+
+        # The parsed options are read once per import session
+        self.session = None
+        self.levels = frozenset()
+        self.highest_level = 0
+        self.names = {}
+
+    def commands(self):
+        backfill_command = Subcommand('dirfields',
+                                      help='sets the fields of the items '
+                                           'already in the library')
+        backfill_command.parser.add_option('-j', '--jobs', type='int',
+                                           default=1,
+                                           help='number of worker processes '
+                                                'computing the fields')
+        backfill_command.parser.add_option('-f', '--force',
+                                           action='store_true', default=False,
+                                           help='overwrite fields already set '
+                                                'by an import')
+        backfill_command.func = self.backfill_command
+        return [backfill_command]
+
+    def queries(self):
+        if self.index:
+            return {INDEX_QUERY_PREFIX: DirFieldQuery,
+                    ALBUM_INDEX_QUERY_PREFIX: AlbumDirFieldQuery}
+        return {}
+
+    def create_index(self, lib):
+        """Creates the table mapping the levels of the item paths to the
+        directory names. Rows of removed items are deleted by a trigger.
+        """
+        self.read_options()
+        with lib.transaction() as tx:
+            tx.script("""
+                CREATE TABLE IF NOT EXISTS dirfields_index (
+                    item_id INTEGER NOT NULL,
+                    level INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY (item_id, level));
+                CREATE INDEX IF NOT EXISTS dirfields_index_name
+                    ON dirfields_index (name, level);
+                CREATE TRIGGER IF NOT EXISTS dirfields_index_delete
+                    AFTER DELETE ON items BEGIN
+                        DELETE FROM dirfields_index WHERE item_id = old.id;
+                    END;
+            """)
+
+    def update_index(self, tx, item_id, fields):
+        """Replaces the rows of the item in the index by the fields."""
+        tx.mutate('DELETE FROM dirfields_index WHERE item_id = ?', (item_id,))
+        for name, value in fields.items():
+            tx.mutate('INSERT INTO dirfields_index (item_id, level, name) '
+                      'VALUES (?, ?, ?)',
+                      (item_id, DirFieldQuery.level(name), value))
+
+    def read_options(self):
+        levels_config = None
+        if 'levels' in self.config:
+            levels_config = self.config['levels'].get()
+        self.levels, self.highest_level = parse_levels(levels_config)
+
+        # Fields can be renamed with the options dir0, dir1, ...
+        self.names = {}
+        for key in self.config.keys():
+            if key.startswith('dir') and key[3:].isdigit():
+                self.names[int(key[3:])] = self.config[key].get()
+        DirFieldQuery.field_levels = dict(
+            (name, level) for level, name in self.names.items())
+
+    def prepare_session(self, session):
+        self.read_options()
+        self.session = session
+
+    def field_name(self, level):
+        """Returns the name of the field of the given level. It can be
+        renamed using the option dir<level>.
+        """
+        return self.names.get(level, 'dir%i' % level)
+
+    def stage(self, session, task):
+        if session is not self.session:
+            self.prepare_session(session)
 
         items = [task.item] if isinstance(task, SingletonImportTask) else task.items + [task.album]
 
-        for item in items:
-            path = os.path.normpath(item.path)
-            dirs = []
-            while path and len(path) > 0:
-                path, file_system_object = os.path.split(path)
-                if not file_system_object or len(file_system_object) == 0:
-                    file_system_object = path.replace(os.path.sep, '')
-                    path = ''
-                dirs.append(file_system_object)
-            dirs.reverse()
-            for idx, dir_name in enumerate(dirs):
-                if idx >= highest_level or idx in levels:
-                    key = 'dir%i' % idx
-                    if key in self.config:
-                        key = self.config[key].get()
-                    item[key] = dir_name
-            item.store()
+        # Items of an album usually share their folder
+        cache = dircache.for_session(session)
+        # All fields of the task are written in a single transaction
+        with session.lib.transaction() as tx:
+            for item in items:
+                path = os.path.normpath(item.path)
+                if item is task.album:
+                    folder, name = path, None
+                else:
+                    folder, name = os.path.split(path)
+                dirs = cache.split(folder, split_path) if folder else []
+                if name:
+                    dirs = dirs + [name]
+                fields = dir_fields(dirs, self.levels, self.highest_level,
+                                    self.field_name)
+                item.update(fields)
+                item.store()
+                if self.index and item is not task.album:
+                    self.update_index(tx, item.id, fields)
+
+    def backfill_command(self, lib, opts, args):
+        """Sets the fields of all items matching the query which have none
+        of them yet. The fields set by an import stem from the path the item
+        was imported from, so they are only recomputed from the current path
+        with --force. Only fields whose stored value differs are written.
+        """
+        self.read_options()
+        fields = partial(path_fields, levels=self.levels,
+                         highest_level=self.highest_level, names=self.names)
+        pool = Pool(opts.jobs) if opts.jobs > 1 else None
+        checked = updated = 0
+        try:
+            for chunk in self.item_chunks(lib, ui.decargs(args)):
+                paths = [path for _, path in chunk]
+                if pool:
+                    chunk_fields = pool.map(fields, paths)
+                else:
+                    chunk_fields = map(fields, paths)
+                ids = [item_id for item_id, _ in chunk]
+                updated += self.store_fields(lib, zip(ids, chunk_fields),
+                                             opts.force)
+                checked += len(chunk)
+                self._log.debug(u'checked {0} items', checked)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        self._log.info(u'Updated {0} of {1} items', updated, checked)
+
+    def item_chunks(self, lib, query_args):
+        """Yields lists of (id, path) of the items matching the query, reading
+        BACKFILL_CHUNK_SIZE items from the database at a time.
+        """
+        query, _ = parse_query_parts(query_args, Item)
+        where, subvals = query.clause()
+        if where is None:
+            # The query cannot be done in SQL, let beets filter the items.
+            # The items are read lazily, so only one chunk is kept.
+            items = ((item.id, item.path) for item in lib.items(query))
+            while True:
+                chunk = list(islice(items, BACKFILL_CHUNK_SIZE))
+                if not chunk:
+                    return
+                yield chunk
+
+        last_id = 0
+        while True:
+            sql = 'SELECT id, path FROM items WHERE id > ?'
+            if where:
+                sql += ' AND ({0})'.format(where)
+            sql += ' ORDER BY id LIMIT ?'
+            with lib.transaction() as tx:
+                rows = tx.query(sql, [last_id] + list(subvals) +
+                                [BACKFILL_CHUNK_SIZE])
+            if not rows:
+                return
+            yield [(row[0], dircache.db_path(row[1])) for row in rows]
+            last_id = rows[-1][0]
+
+    def store_fields(self, lib, chunk, force=False):
+        """Writes the fields of a chunk of (id, fields) in one transaction.
+        Items having any of the fields already are left alone unless force is
+        set. Returns the number of items changed.
+        """
+        names = set()
+        for _, fields in chunk:
+            names.update(fields)
+        fixed = [name for name in names if name in Item._fields]
+        flexible = [name for name in names if name not in Item._fields]
+        ids = [item_id for item_id, _ in chunk]
+        id_params = ','.join('?' * len(ids))
+
+        with lib.transaction() as tx:
+            stored = dict((item_id, {}) for item_id in ids)
+            if flexible:
+                rows = tx.query(
+                    'SELECT entity_id, key, value FROM item_attributes '
+                    'WHERE entity_id IN ({0}) AND key IN ({1})'.format(
+                        id_params, ','.join('?' * len(flexible))),
+                    ids + flexible)
+                for item_id, key, value in rows:
+                    stored[item_id][key] = dircache.db_path(value)
+            if fixed:
+                rows = tx.query('SELECT id, {0} FROM items WHERE id IN '
+                                '({1})'.format(', '.join(fixed), id_params),
+                                ids)
+                for row in rows:
+                    for key, value in zip(fixed, row[1:]):
+                        stored[row[0]][key] = dircache.db_path(value)
+
+            changed = 0
+            for item_id, fields in chunk:
+                if not force and any(stored[item_id].get(key)
+                                     for key in fields):
+                    if self.index:
+                        self.update_index(tx, item_id, dict(
+                            (key, value)
+                            for key, value in stored[item_id].items()
+                            if value))
+                    continue
+                item_changed = False
+                for key, value in fields.items():
+                    if stored[item_id].get(key) == value:
+                        continue
+                    item_changed = True
+                    if key in Item._fields:
+                        tx.mutate('UPDATE items SET {0} = ? WHERE id = ?'
+                                  .format(key), (value, item_id))
+                    else:
+                        tx.mutate('INSERT INTO item_attributes '
+                                  '(entity_id, key, value) VALUES (?, ?, ?)',
+                                  (item_id, key, value))
+                if item_changed:
+                    changed += 1
+                if self.index:
+                    self.update_index(tx, item_id, fields)
+        return changed
@@ -11,17 +11,42 @@
 #
 # The above copyright notice and this permission notice shall be
 # included in all copies or substantial portions of the Software.
+import json
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
+
 from beets.plugins import BeetsPlugin, find_plugins
+from beets.util import displayable_path
+
+from beetsplug import dircache
 
 
 class MultipleTaskCreated(BeetsPlugin):
     def __init__(self):
         super(MultipleTaskCreated, self).__init__()
 
+        self.config.add({
+            'trace_file': None,
+            'threads': 0
+        })
+
         self.plugins = []
+        # Time spent in each plugin and the number of tasks it got and
+        # returned during the current session
+        self.stats = OrderedDict()
+        self.trace = None
+        self.stats_lock = threading.Lock()
+        # Runs the remaining plugins for the tasks created by the first one
+        # if the threads option is set
+        self.pool = None
+        # The session whose directory cache is dropped when the import ends
+        self.session = None
         self.register_listener('import_task_created',
                                self.import_task_created_event)
         self.register_listener('pluginload', self.loaded)
+        self.register_listener('import', self.import_event)
 
     def loaded(self):
         plugin_map = {}
@@ -40,12 +65,91 @@ class MultipleTaskCreated(BeetsPlugin):
         :type task: ImportTask
         :type session: ImportSession
         """
-        tasks = [task]
-        for plugin in self.plugins:
-            new_tasks = []
-            for current_task in tasks:
-                new_tasks.extend(plugin.import_task_created_event(session, current_task,
-                                                                  chained=True))
-            tasks = new_tasks
-
-        return tasks
+        self.session = session
+        return self.chain(session, [task], self.plugins)
+
+    def chain(self, session, tasks, plugins):
+        """Passes each task through all plugins before the next task is
+        processed. A plugin returning None keeps the task unchanged.
+        """
+        if not plugins:
+            for task in tasks:
+                yield task
+            return
+
+        plugin = plugins[0]
+        for task in tasks:
+            start = timer()
+            new_tasks = plugin.import_task_created_event(session, task,
+                                                         chained=True)
+            if new_tasks is None:
+                new_tasks = [task]
+            else:
+                new_tasks = list(new_tasks)
+            self.record(plugin, task, timer() - start, len(new_tasks))
+
+            if plugins is self.plugins and len(plugins) > 1 \
+                    and len(new_tasks) > 1 and self.get_pool():
+                # The tasks created by the first plugin are independent of
+                # each other. imap keeps their order.
+                results = self.pool.imap(
+                    lambda new_task: list(self.chain(session, [new_task],
+                                                     plugins[1:])),
+                    new_tasks)
+                for result in results:
+                    for new_task in result:
+                        yield new_task
+            else:
+                for new_task in self.chain(session, new_tasks, plugins[1:]):
+                    yield new_task
+
+    def get_pool(self):
+        if self.pool is None and self.config['threads'].get(int) > 0:
+            self.pool = ThreadPool(self.config['threads'].get(int))
+        return self.pool
+
+    def record(self, plugin, task, elapsed, tasks_out):
+        """Adds a call of a plugin to the statistics and writes it to the
+        trace file if one is configured.
+        """
+        with self.stats_lock:
+            stats = self.stats.get(plugin.name)
+            if stats is None:
+                stats = self.stats[plugin.name] = {'time': 0.0, 'tasks_in': 0,
+                                                   'tasks_out': 0}
+            stats['time'] += elapsed
+            stats['tasks_in'] += 1
+            stats['tasks_out'] += tasks_out
+
+            if self.trace is None and self.config['trace_file'].get():
+                self.trace = open(self.config['trace_file'].as_filename(), 'a')
+            if self.trace:
+                paths = getattr(task, 'paths', None)
+                self.trace.write(json.dumps({
+                    'plugin': plugin.name,
+                    'task': displayable_path(paths[0]) if paths else None,
+                    'time': elapsed,
+                    'tasks_out': tasks_out,
+                }) + '\n')
+
+    def import_event(self, lib, paths):
+        """Logs the statistics of the session and resets them. Stops the
+        threads and drops the directory cache of the session."""
+        for name, stats in self.stats.items():
+            self._log.info(u'{0}: {1:.0f} ms, {2} tasks in, {3} tasks out',
+                           name, stats['time'] * 1000, stats['tasks_in'],
+                           stats['tasks_out'])
+        self.stats = OrderedDict()
+        if self.session is not None:
+            cache = dircache.invalidate(self.session)
+            if cache:
+                self._log.info(u'directory cache: {0} hits, {1} misses',
+                               cache.hits, cache.misses)
+            self.session = None
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
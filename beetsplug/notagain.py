@@ -11,23 +11,533 @@
 #
 # The above copyright notice and this permission notice shall be
 # included in all copies or substantial portions of the Software.
-from beets import config
+import fnmatch
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import struct
+import threading
+import time
+
+from beets import config, ui
 from beets.importer import SingletonImportTask, SentinelImportTask, ArchiveImportTask
 from beets.library import PathQuery
 from beets.plugins import BeetsPlugin
-from beets.util import bytestring_path, displayable_path
+from beets.ui import Subcommand
+from beets.util import bytestring_path, displayable_path, syspath
+
+from beetsplug import dircache
+
+# Files with these extensions are ignored when pre-scanning the paths to
+# import, as they are never part of the library. beets recognizes audio
+# files by their content, so every other file may be imported.
+NON_AUDIO_EXTENSIONS = frozenset([
+    b'.accurip', b'.bmp', b'.cue', b'.db', b'.doc', b'.gif', b'.htm',
+    b'.html', b'.ini', b'.jpeg', b'.jpg', b'.log', b'.lrc', b'.m3u',
+    b'.m3u8', b'.md5', b'.nfo', b'.pdf', b'.pls', b'.png', b'.rtf', b'.sfv',
+    b'.tif', b'.tiff', b'.toc', b'.txt', b'.url', b'.webp', b'.xml'])
+
+# Number of paths inserted into the temporary table by a single statement
+# (SQLite limits the number of host parameters per statement).
+PRESCAN_CHUNK_SIZE = 500
+
+# Directory names marking the discs of a multi-disc album. beets collapses
+# such directories into one album, so the pre-scan never splits their parent.
+MULTI_DISC_PATTERN = re.compile(r'^(.*(?:dis[ck]|cd)[\W_]*)\d', re.I)
+
+
+def path_key(path):
+    """Returns the key used to store a path in the path set. A digest is
+    much smaller than the path itself."""
+    return hashlib.md5(bytestring_path(path)).digest()
+
+
+def directory_fingerprint(path, cache=None):
+    """Returns a fingerprint of a directory built from the names, sizes and
+    modification times of its entries. No file is opened to build it. The
+    entries are read through the directory cache if one is given."""
+    entries = []
+    if cache is None:
+        path = syspath(path)
+        for name in os.listdir(path):
+            stat = os.stat(os.path.join(path, name))
+            entries.append((name, stat.st_size, stat.st_mtime))
+    else:
+        for name, stat in cache.entry_stats(path):
+            if stat is None:
+                raise OSError(u'{0} vanished'.format(
+                    displayable_path(os.path.join(path, name))))
+            entries.append((name, stat.st_size, stat.st_mtime))
+    entries.sort()
+    return hashlib.sha1(repr(entries)).hexdigest()
+
+
+def audio_range(f, size):
+    """Returns the start and end offsets of the audio data of the file f
+    of the given size, i.e. without leading ID3v2 or FLAC metadata and
+    trailing APEv2 or ID3v1 tags. Tags are rewritten by beets, the audio
+    data is not. Other formats are returned as a whole."""
+    start = 0
+    f.seek(0)
+    header = f.read(10)
+    # ID3v2 tags (possibly more than one)
+    while len(header) == 10 and header[:3] == b'ID3':
+        tag_size = 0
+        for byte in bytearray(header[6:10]):
+            tag_size = (tag_size << 7) | (byte & 0x7f)
+        start += 10 + tag_size + (10 if ord(header[5:6]) & 0x10 else 0)
+        f.seek(start)
+        header = f.read(10)
+    # FLAC metadata blocks
+    if header[:4] == b'fLaC':
+        start += 4
+        while True:
+            f.seek(start)
+            block_header = bytearray(f.read(4))
+            if len(block_header) < 4:
+                break
+            start += 4 + ((block_header[1] << 16) | (block_header[2] << 8) |
+                          block_header[3])
+            if block_header[0] & 0x80:
+                break
+
+    end = size
+    # ID3v1 tag
+    if end - start >= 128:
+        f.seek(end - 128)
+        if f.read(3) == b'TAG':
+            end -= 128
+    # APEv2 tag
+    if end - start >= 32:
+        f.seek(end - 32)
+        footer = f.read(32)
+        if footer[:8] == b'APETAGEX':
+            tag_size, _, flags = struct.unpack('<III', footer[12:24])
+            end -= tag_size + (32 if flags & 0x80000000 else 0)
+    if end <= start:
+        return 0, size
+    return start, end
+
+
+def content_fingerprint(path, chunk_size):
+    """Returns a fingerprint of the audio data of a file: the size of the
+    audio data and a hash of its first and last chunk_size bytes."""
+    path = syspath(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        start, end = audio_range(f, os.fstat(f.fileno()).st_size)
+        f.seek(start)
+        if end - start <= 2 * chunk_size:
+            digest.update(f.read(end - start))
+        else:
+            digest.update(f.read(chunk_size))
+            f.seek(end - chunk_size)
+            digest.update(f.read(chunk_size))
+    return end - start, digest.digest()
 
 
 class NotAgain(BeetsPlugin):
     def __init__(self):
         super(NotAgain, self).__init__()
 
-        self.config.add({'quiet': False})
+        self.config.add({
+            'quiet': False,
+            'dir_fingerprints': False,
+            'content_hash': False,
+            'content_hash_kb': 64,
+            'relink': False,
+            'prefilter': False,
+            'state_file': None
+        })
 
         self.chained = False
 
+        # Digests of the paths of all items in the library. Loaded once per
+        # import session and kept current by the imported events. Tasks may
+        # be checked by several threads (see multipletaskcreated).
+        self.library_paths = None
+        self.session = None
+        self.library_paths_lock = threading.Lock()
+        # Persisted state. 'dirs' maps the path of a directory imported
+        # before to its fingerprint and the path keys of its items. The
+        # content fingerprints are kept in the notagain_content table of the
+        # library.
+        self.state = None
+        self.state_changed = False
+        # The library whose content table is known to exist
+        self.content_lib = None
+
         self.register_listener('import_task_created',
                                self.import_task_created_event)
+        self.register_listener('import_task_files',
+                               self.import_task_files_event)
+        self.register_listener('import_begin', self.import_begin_event)
+        self.register_listener('item_imported', self.item_imported_event)
+        self.register_listener('album_imported', self.album_imported_event)
+        self.register_listener('import', self.import_event)
+
+    def commands(self):
+        index_command = Subcommand('notagainindex',
+                                   help='adds the content fingerprints of '
+                                        'the selected items to the index '
+                                        'used by the content_hash mode')
+        index_command.func = self.index_command
+        return [index_command]
+
+    def index_command(self, lib, opts, args):
+        count = 0
+        for item in lib.items(ui.decargs(args)):
+            try:
+                self.index_content(lib, item.path)
+                count += 1
+            except (IOError, OSError) as exc:
+                self._log.warn(u'Unable to read {0}: {1}',
+                               displayable_path(item.path), exc)
+        self.save_state()
+        self._log.info(u'Indexed {0} items', count)
+
+    def load_library_paths(self, session):
+        """Reads the paths of all items of the library using one query."""
+        with session.lib.transaction() as tx:
+            rows = tx.query('SELECT path FROM items')
+        self.library_paths = set(path_key(dircache.db_path(row[0]))
+                                 for row in rows)
+        self.session = session
+        self._log.debug(u'Loaded {0} paths from the library',
+                        len(self.library_paths))
+
+    def get_library_paths(self, session):
+        """Returns the path set, which is read once per session."""
+        with self.library_paths_lock:
+            if session is not self.session:
+                self.load_library_paths(session)
+            return self.library_paths
+
+    def in_library(self, session, path):
+        return path_key(path) in self.get_library_paths(session)
+
+    def item_imported_event(self, lib, item):
+        self.item_added(lib, item.path)
+
+    def album_imported_event(self, lib, album):
+        for item in album.items():
+            self.item_added(lib, item.path)
+
+    def item_added(self, lib, path):
+        if self.library_paths is not None:
+            self.library_paths.add(path_key(path))
+        if self.config['content_hash'].get(bool):
+            try:
+                self.index_content(lib, path)
+            except (IOError, OSError) as exc:
+                self._log.debug(u'Unable to index {0}: {1}',
+                                displayable_path(path), exc)
+
+    def create_content_table(self, lib):
+        """Creates the table mapping content fingerprints to paths in the
+        library database."""
+        if lib is self.content_lib:
+            return
+        with lib.transaction() as tx:
+            tx.mutate('CREATE TABLE IF NOT EXISTS notagain_content ('
+                      'size INTEGER NOT NULL, '
+                      'digest BLOB NOT NULL, '
+                      'path BLOB NOT NULL, '
+                      'PRIMARY KEY (size, digest))')
+        self.content_lib = lib
+
+    def index_content(self, lib, path):
+        size, digest = content_fingerprint(
+            path, self.config['content_hash_kb'].get(int) * 1024)
+        self.create_content_table(lib)
+        with lib.transaction() as tx:
+            tx.mutate('INSERT OR REPLACE INTO notagain_content '
+                      '(size, digest, path) VALUES (?, ?, ?)',
+                      (size, sqlite3.Binary(digest),
+                       sqlite3.Binary(bytestring_path(path))))
+
+    def find_content(self, lib, fingerprint):
+        """Returns the path of the item indexed with the content fingerprint
+        or None."""
+        size, digest = fingerprint
+        self.create_content_table(lib)
+        with lib.transaction() as tx:
+            rows = tx.query('SELECT path FROM notagain_content '
+                            'WHERE size = ? AND digest = ?',
+                            (size, sqlite3.Binary(digest)))
+        return bytes(rows[0][0]) if rows else None
+
+    def item_known(self, session, item, library_base_path):
+        """Checks if an item is already present at the library, either by
+        its path or, in the content_hash mode, by its content."""
+        if item.path.startswith(library_base_path) and \
+                self.in_library(session, item.path):
+            return True
+        if not self.config['content_hash'].get(bool):
+            return False
+
+        try:
+            fingerprint = content_fingerprint(
+                item.path, self.config['content_hash_kb'].get(int) * 1024)
+        except (IOError, OSError):
+            return False
+        known_path = self.find_content(session.lib, fingerprint)
+        if known_path is None or not self.in_library(session, known_path):
+            return False
+        if dircache.for_session(session).exists(known_path):
+            # The same content is already imported from somewhere else
+            return True
+        if self.config['relink'].get(bool) and \
+                item.path.startswith(library_base_path):
+            # The file was moved or renamed inside the library
+            self.relink(session, known_path, item.path)
+            return True
+        return False
+
+    def relink(self, session, old_path, new_path):
+        """Changes the path of the library item at old_path to new_path."""
+        lib_item = session.lib.items(PathQuery('path', old_path)).get()
+        if not lib_item:
+            return
+        lib_item.path = new_path
+        lib_item.store()
+        self.library_paths.discard(path_key(old_path))
+        self.library_paths.add(path_key(new_path))
+        self.index_content(session.lib, new_path)
+        self._log.info(u'Relinked {0} to {1}', displayable_path(old_path),
+                       displayable_path(new_path))
+
+    def import_event(self, lib, paths):
+        # The import session is over
+        self.save_state()
+        self.library_paths = None
+        self.session = None
+
+    def get_state_path(self):
+        path = self.config['state_file'].get()
+        if not path:
+            path = os.path.join(config.config_dir(), 'notagain.pickle')
+        return syspath(bytestring_path(path))
+
+    def load_state(self):
+        if self.state is not None:
+            return self.state
+        self.state = {'dirs': {}}
+        path = self.get_state_path()
+        if os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.state.update(pickle.load(f))
+            except Exception as exc:
+                self._log.warn(u'Ignoring corrupt state file {0}: {1}',
+                               displayable_path(path), exc)
+        return self.state
+
+    def save_state(self):
+        if not self.state_changed:
+            return
+        path = self.get_state_path()
+        tmp_path = path + b'.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.state, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.isfile(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+        self.state_changed = False
+
+    def record_directory(self, path, item_paths):
+        """Remembers that the items at item_paths were imported from the
+        directory at path in its current state."""
+        self.load_state()['dirs'][path] = \
+            (directory_fingerprint(path), [path_key(p) for p in item_paths])
+        self.state_changed = True
+
+    def directory_unchanged(self, session, path):
+        """Checks if the directory at path has not changed since it was
+        imported and all of its items are still in the library. This does
+        not read any file."""
+        entry = self.load_state()['dirs'].get(path)
+        cache = dircache.for_session(session)
+        if not entry or not cache.is_dir(path):
+            return False
+        fingerprint, keys = entry
+        try:
+            if fingerprint != directory_fingerprint(path, cache):
+                return False
+        except OSError:
+            return False
+        library_paths = self.get_library_paths(session)
+        return all(key in library_paths for key in keys)
+
+    def import_begin_event(self, session):
+        prefilter = self.config['prefilter'].get(bool)
+        dir_fingerprints = self.config['dir_fingerprints'].get(bool)
+        if not prefilter and not dir_fingerprints:
+            return
+        if 'library' in config['import'] and config['import']['library']:
+            return
+        start = time.time()
+        paths, skipped = self.prefilter(session, session.paths,
+                                        dircache.for_session(session),
+                                        prefilter, dir_fingerprints)
+        # The paths given by the user are kept for the toppath of the tasks
+        # and for other plugins relating files to them.
+        if not hasattr(session, 'original_paths'):
+            session.original_paths = list(session.paths)
+        session.paths[:] = paths
+        self._log.info(u'Pre-scan skipped {0} files already present at the '
+                       u'library in {1:.0f} ms', skipped,
+                       (time.time() - start) * 1000)
+
+    def prefilter(self, session, paths, cache, lookup_files=True,
+                  dir_fingerprints=False):
+        """Walks the given import paths once, before beets reads any file.
+        Returns the paths beets still needs to import and the number of
+        skipped files: directories whose whole subtree is already present
+        at the library are left out; a directory containing new files is
+        kept with its subtree.
+
+        :param lookup_files: Look up all files found at the library
+            using a single join.
+        :param dir_fingerprints: Consider directories which did not change
+            since they were imported as present.
+        """
+        ignore = config['ignore'].as_str_seq()
+        ignore_hidden = config['ignore_hidden'].get(bool)
+        library_base_path = bytestring_path(config['directory'].get())
+
+        # Maps each directory to its audio files and sub directories
+        tree = {}
+        for path in paths:
+            if cache.is_dir(bytestring_path(path)):
+                self.scan_tree(bytestring_path(path), tree, ignore,
+                               ignore_hidden, cache)
+        known = set()
+        if lookup_files:
+            known = self.find_in_library(
+                session.lib, [f for files, _ in tree.values() for f in files
+                              if f.startswith(library_base_path)])
+
+        def prune(directory):
+            """Returns whether the directory is fully present at the
+            library, the paths to import and the number of skipped files."""
+            files, sub_dirs = tree[directory]
+            if dir_fingerprints and directory.startswith(library_base_path) \
+                    and self.directory_unchanged(session, directory):
+                new_files = []
+            else:
+                new_files = [f for f in files if f not in known]
+            results = [prune(sub_dir) for sub_dir in sub_dirs]
+            if not new_files and all(clean for clean, _, _ in results):
+                return True, [], len(files) + sum(s for _, _, s in results)
+            if new_files or any(
+                    MULTI_DISC_PATTERN.match(os.path.basename(sub_dir))
+                    for sub_dir in sub_dirs):
+                return False, [directory], 0
+            kept = []
+            skipped = len(files)
+            for clean, sub_kept, sub_skipped in results:
+                kept.extend(sub_kept)
+                skipped += sub_skipped
+            return False, kept, skipped
+
+        new_paths = []
+        skipped = 0
+        for path in paths:
+            if bytestring_path(path) not in tree:
+                # Single files and archives are left to beets
+                new_paths.append(path)
+                continue
+            _, kept, path_skipped = prune(bytestring_path(path))
+            new_paths.extend(kept)
+            skipped += path_skipped
+        return new_paths, skipped
+
+    @staticmethod
+    def scan_tree(top, tree, ignore, ignore_hidden, cache):
+        """Collects the files which may be audio files and the sub
+        directories of all directories below top (including top) into tree. The directories are listed
+        through the directory cache, so later plugins do not list them
+        again."""
+        pending = [top]
+        while pending:
+            directory = pending.pop()
+            files = []
+            sub_dirs = []
+            entries = cache.entries(directory)
+            for name, is_dir in entries:
+                if (ignore_hidden and name.startswith(b'.')) or \
+                        any(fnmatch.fnmatch(name, pattern)
+                            for pattern in ignore):
+                    continue
+                path = os.path.join(directory, name)
+                if is_dir:
+                    sub_dirs.append(path)
+                elif os.path.splitext(name)[1].lower() not in \
+                        NON_AUDIO_EXTENSIONS:
+                    files.append(path)
+            tree[directory] = (files, sub_dirs)
+            pending.extend(sub_dirs)
+
+    @staticmethod
+    def find_in_library(lib, paths):
+        """Returns the subset of paths belonging to items of the library.
+        The paths are put into a temporary table which is joined with the
+        items."""
+        known = set()
+        if not paths:
+            return known
+        with lib.transaction() as tx:
+            tx.mutate('CREATE TEMPORARY TABLE IF NOT EXISTS notagain_scan '
+                      '(path BLOB)')
+            tx.mutate('DELETE FROM notagain_scan')
+            for start in range(0, len(paths), PRESCAN_CHUNK_SIZE):
+                chunk = paths[start:start + PRESCAN_CHUNK_SIZE]
+                tx.mutate('INSERT INTO notagain_scan (path) VALUES ' +
+                          ', '.join(['(?)'] * len(chunk)),
+                          [sqlite3.Binary(path) for path in chunk])
+            rows = tx.query('SELECT s.path FROM notagain_scan s '
+                            'JOIN items i ON i.path = s.path')
+            tx.mutate('DROP TABLE notagain_scan')
+        for row in rows:
+            known.add(bytes(row[0]))
+        return known
+
+    @staticmethod
+    def restore_toppath(session, task):
+        """Sets the toppath of a task created below a directory picked by
+        the pre-scan back to the import path given by the user, which beets
+        uses to prune emptied directories and to record the progress."""
+        if not task.toppath:
+            return
+        toppath = bytestring_path(task.toppath)
+        for path in sorted(getattr(session, 'original_paths', []), key=len,
+                           reverse=True):
+            path = bytestring_path(path)
+            if toppath == path:
+                return
+            if toppath.startswith(os.path.join(path, b'')):
+                task.toppath = path
+                return
+
+    def import_task_files_event(self, session, task):
+        if not self.config['dir_fingerprints'].get(bool) or \
+                isinstance(task, SingletonImportTask):
+            return
+        self.record_task_directories(task)
+
+    def record_task_directories(self, task):
+        """Records the directories of an album task which are located inside
+        the library."""
+        library_base_path = bytestring_path(config['directory'].get())
+        for path in task.paths:
+            if path.startswith(library_base_path) and \
+                    os.path.isdir(syspath(path)):
+                self.record_directory(path, [item.path for item in task.items
+                                             if os.path.dirname(item.path) ==
+                                             path])
 
     def import_task_created_event(self, session, task, chained=False):
         """
@@ -35,6 +545,7 @@ class NotAgain(BeetsPlugin):
         :type task: ImportTask
         :type session: ImportSession
         """
+        self.restore_toppath(session, task)
         if self.chained and not chained:
             return None
 
@@ -51,9 +562,8 @@ class NotAgain(BeetsPlugin):
         items_to_remove = []
         if isinstance(task, SingletonImportTask):
             for item in task.items:
-                # Check if path of current item is located inside the library
-                if item.path.startswith(library_base_path) and \
-                        session.lib.items(PathQuery('path', item.path)):
+                # Check if the current item is already present at the library
+                if self.item_known(session, item, library_base_path):
                     items_to_remove.append(item)
 
             for item in items_to_remove:
@@ -66,14 +576,17 @@ class NotAgain(BeetsPlugin):
 
             return [task] if len(task.items) > 0 else []
 
-        # This is an album. Check if all files which should be imported
-        # are already in the library. Import again if not.
+        # This is an album. Directories which did not change since they were
+        # imported are already left out by the walk at import_begin.
+
+        # Check if all files which should be imported are already in the
+        # library. Import again if not.
         for item in task.items:
-            # Check if path of current item is located inside the library
-            if not item.path.startswith(library_base_path) or \
-                    not session.lib.items(PathQuery('path', item.path)):
+            if not self.item_known(session, item, library_base_path):
                 return [task]
 
+        if self.config['dir_fingerprints'].get(bool):
+            self.record_task_directories(task)
         if not quiet:
             self._log.info(u'Skipping album {0}: already present at the library.'.format(
                 displayable_path(task.paths[0])))
@@ -12,15 +12,165 @@
 # The above copyright notice and this permission notice shall be
 # included in all copies or substantial portions of the Software.
 
+import fnmatch
 import logging
 import os
 import re
-from beets import config
+from collections import Counter
+from timeit import default_timer as timer
+from beets import config, plugins
 from beets.importer import action, SingletonImportTask
 from beets.plugins import BeetsPlugin
+from beets.util import bytestring_path, syspath
+
+from beetsplug import dircache
 
 log = logging.getLogger('beets')
 
+# Maximum number of single names added to the ignore list when pruning the
+# directory walk. beets matches every entry against every ignore pattern.
+PRUNE_MAX_NAMES = 200
+
+# Back references and conditional groups prevent combining regular
+# expressions into a single one.
+BACK_REFERENCE = re.compile(r'\\\d|\(\?P=|\(\?\(')
+
+
+def glob_escape(name):
+    """Escapes a name so it only matches itself as a glob pattern."""
+    return re.sub(r'([*?[])', r'[\1]', name)
+
+
+class Rule(object):
+    """A single include or exclude rule for folder or file names. The
+    pattern is a regular expression (matched at the start of the name, like
+    the *_name_regex options) or, for prefix and suffix rules, a literal.
+    """
+    def __init__(self, include, kind, pattern, literal=None):
+        self.include = include
+        self.kind = kind
+        self.pattern = pattern
+        self.literal = literal
+
+    @classmethod
+    def from_config(cls, rule_config):
+        """Creates a rule from a config entry like
+        ``exclude_folder: 'scans'`` or ``include_file_suffix: '.mp3'``.
+        """
+        if not isinstance(rule_config, dict) or len(rule_config) != 1:
+            raise ValueError(u'invalid rule {0!r}'.format(rule_config))
+        key, pattern = list(rule_config.items())[0]
+        parts = key.split('_')
+        if len(parts) not in (2, 3) or \
+                parts[0] not in ('include', 'exclude') or \
+                parts[1] not in ('folder', 'file') or \
+                (len(parts) == 3 and parts[2] not in ('prefix', 'suffix')):
+            raise ValueError(u'invalid rule {0!r}'.format(key))
+        return cls(parts[0] == 'include', parts[1], unicode(pattern),
+                   parts[2] if len(parts) == 3 else None)
+
+    def __unicode__(self):
+        return u'{0}_{1}{2}: {3}'.format(
+            'include' if self.include else 'exclude', self.kind,
+            '_' + self.literal if self.literal else '', self.pattern)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class RuleSet(object):
+    """An ordered list of rules of one kind. The first matching rule
+    decides whether a name is allowed; names no rule matches are allowed.
+
+    Consecutive rules with the same action are checked at once: literal
+    rules using str.startswith/endswith with a tuple of literals, regular
+    expressions as a single combined pattern.
+    """
+    def __init__(self, rules, ignore_case=False):
+        self.rules = rules
+        self.ignore_case = ignore_case
+
+        runs = []
+        for rule in rules:
+            key = (rule.include, rule.literal is not None)
+            if runs and runs[-1][0] == key:
+                runs[-1][1].append(rule)
+            else:
+                runs.append((key, [rule]))
+        self.matchers = [self._compile_literals(run_rules) if literal
+                         else self._compile_regexes(run_rules)
+                         for (_, literal), run_rules in runs]
+
+    def _compile_literals(self, rules):
+        # Names are byte strings
+        literals = [(bytestring_path(rule.pattern.lower() if self.ignore_case
+                                     else rule.pattern), rule)
+                    for rule in rules]
+        prefixes = tuple(l for l, rule in literals if rule.literal == 'prefix')
+        suffixes = tuple(l for l, rule in literals if rule.literal == 'suffix')
+
+        def matcher(name):
+            if self.ignore_case:
+                name = name.lower()
+            if (prefixes and name.startswith(prefixes)) or \
+                    (suffixes and name.endswith(suffixes)):
+                # Find the first matching rule of the run
+                for literal, rule in literals:
+                    if name.startswith(literal) if rule.literal == 'prefix' \
+                            else name.endswith(literal):
+                        return rule
+            return None
+        return matcher
+
+    def _compile_regexes(self, rules):
+        flags = re.IGNORECASE if self.ignore_case else 0
+        # Names are byte strings, so the patterns are encoded like the
+        # literals
+        patterns = [bytestring_path(rule.pattern) for rule in rules]
+        # Wrap each pattern into a group. The group of the first matching
+        # alternative is the last matched group, as it encloses all groups
+        # of its pattern.
+        group_rules = {}
+        group = 1
+        for pattern, rule in zip(patterns, rules):
+            group_rules[group] = rule
+            group += re.compile(pattern, flags).groups + 1
+        try:
+            if any(BACK_REFERENCE.search(pattern) for pattern in patterns):
+                # Group numbers change when combining the patterns
+                raise re.error('back reference')
+            combined = re.compile(b'|'.join(b'(' + pattern + b')'
+                                            for pattern in patterns), flags)
+        except re.error:
+            # Patterns using back references or the same group names
+            # cannot be combined.
+            regexes = [(re.compile(pattern, flags), rule)
+                       for pattern, rule in zip(patterns, rules)]
+
+            def matcher(name):
+                for regex, rule in regexes:
+                    if regex.match(name):
+                        return rule
+                return None
+            return matcher
+
+        def matcher(name):
+            match = combined.match(name)
+            return group_rules[match.lastindex] if match else None
+        return matcher
+
+    def match(self, name):
+        """Returns the first rule matching the name or None."""
+        for matcher in self.matchers:
+            rule = matcher(name)
+            if rule is not None:
+                return rule
+        return None
+
+    def allowed(self, name):
+        rule = self.match(name)
+        return rule is None or rule.include
+
 
 class RegexFileFilterPlugin(BeetsPlugin):
     def __init__(self):
@@ -28,15 +178,24 @@ class RegexFileFilterPlugin(BeetsPlugin):
 
         self.register_listener('import_task_created',
                                self.import_task_created_event)
+        self.register_listener('import_begin', self.import_begin_event)
+        self.register_listener('import', self.import_event)
 
         self.config.add({
             'ignore_case': False,
             'invert_folder_result': False,
             'invert_file_result': False,
             'folder_name_regex': '.*',
-            'file_name_regex': '.*'
+            'file_name_regex': '.*',
+            'rules': [],
+            'prune_walk': False,
+            'stats': False
         })
         flags = re.IGNORECASE if self.config['ignore_case'].get() else 0
+        rules = self.get_rules(self.config)
+        self.folder_album_rules = self.folder_singleton_rules = \
+            rules['folder']
+        self.file_album_rules = self.file_singleton_rules = rules['file']
 
         self.invert_folder_album_result = \
             self.invert_folder_singleton_result = \
@@ -65,6 +224,10 @@ class RegexFileFilterPlugin(BeetsPlugin):
             if 'file_name_regex' in album_config:
                 self.file_name_album_regex = re.compile(
                     album_config['file_name_regex'].get(), flags)
+            if 'rules' in album_config:
+                rules = self.get_rules(album_config)
+                self.folder_album_rules = rules['folder']
+                self.file_album_rules = rules['file']
 
         if 'singleton' in self.config:
             singleton_config = self.config['singleton']
@@ -80,25 +243,172 @@ class RegexFileFilterPlugin(BeetsPlugin):
             if 'file_name_regex' in singleton_config:
                 self.file_name_singleton_regex = re.compile(
                     singleton_config['file_name_regex'].get(), flags)
+            if 'rules' in singleton_config:
+                rules = self.get_rules(singleton_config)
+                self.folder_singleton_rules = rules['folder']
+                self.file_singleton_rules = rules['file']
+
+        # Per import session: the base paths sorted by length (longest
+        # first), the mode and the verdicts of the folder regex by relative
+        # folder path.
+        self.session = None
+        # The ignore option as it was before pruning the walk
+        self.original_ignore = None
+        self.base_paths = []
+        self.singletons = False
+        self.folder_cache = {}
+
+        # Number of files checked, time spent checking them and the number
+        # of files and folders rejected by each pattern
+        self.reset_stats()
+
+    def get_rules(self, mode_config):
+        """Reads the rules option of a config view into a folder and a file
+        rule set."""
+        ignore_case = bool(self.config['ignore_case'].get())
+        rules = [Rule.from_config(rule_config)
+                 for rule_config in mode_config['rules'].get(list) or []]
+        return dict((kind, RuleSet([r for r in rules if r.kind == kind],
+                                   ignore_case))
+                    for kind in ('folder', 'file'))
+
+    def prepare_session(self, session):
+        if session is self.session:
+            return
+        self.session = session
+        # The folder regex applies to the folders below the paths given by
+        # the user, even if another plugin narrowed session.paths down.
+        self.base_paths = sorted(getattr(session, 'original_paths',
+                                         session.paths),
+                                 key=len, reverse=True)
+        self.singletons = bool(config['import']['singletons'].get())
+        self.folder_cache = {}
+
+    def import_begin_event(self, session):
+        """Lets beets skip folders and files rejected by the regular
+        expressions while it walks the import paths, so their files are
+        never read. beets only supports ignoring entries by name (the
+        'ignore' option), so the import paths are walked once up front
+        (without reading any file) and names which are rejected wherever
+        they occur are added to the ignore list for this import.
+        """
+        self.restore_ignore()
+        if not self.config['prune_walk'].get(bool):
+            return
+        self.prepare_session(session)
+
+        ignore = config['ignore'].as_str_seq()
+        ignore_hidden = config['ignore_hidden'].get(bool)
+        rejected = set()
+        accepted = set()
+        cache = dircache.for_session(session)
+        for base_path in session.paths:
+            base_path = bytestring_path(base_path)
+            if not cache.is_dir(base_path):
+                continue
+            pending = [base_path]
+            while pending:
+                path = pending.pop()
+                entries = cache.entries(path)
+                dirs = [name for name, is_dir in entries if is_dir]
+                dir_names = set(dirs)
+                names = set(name for name, _ in entries
+                            if not (ignore_hidden and name.startswith('.')) and
+                            not any(fnmatch.fnmatch(name, pattern)
+                                    for pattern in ignore))
+                for name in names:
+                    if name in dir_names:
+                        allowed = self.folder_filter(name, self.singletons)
+                    else:
+                        allowed = self.file_name_filter(name,
+                                                        self.singletons)
+                    (accepted if allowed else rejected).add(name)
+                # Do not descend into rejected folders
+                pending.extend(os.path.join(path, name) for name in dirs
+                               if name in names and name not in rejected)
+        rejected -= accepted
+        if not rejected:
+            return
+
+        # Ignore whole extensions if no accepted entry has them; single
+        # names only as long as the list stays short.
+        accepted_extensions = set(os.path.splitext(name)[1].lower()
+                                  for name in accepted)
+        patterns = set()
+        names = []
+        for name in rejected:
+            extension = os.path.splitext(name)[1]
+            if extension and extension.lower() not in accepted_extensions:
+                patterns.add('*' + glob_escape(extension))
+            else:
+                names.append(name)
+        if len(names) > PRUNE_MAX_NAMES:
+            self._log.debug(u'not pruning {0} names',
+                            len(names) - PRUNE_MAX_NAMES)
+        patterns.update(glob_escape(name)
+                        for name in sorted(names)[:PRUNE_MAX_NAMES])
+
+        self.original_ignore = ignore
+        config['ignore'] = ignore + sorted(patterns)
+        self._log.debug(u'pruning the walk using {0} patterns', len(patterns))
+
+    def import_event(self, lib, paths):
+        self.restore_ignore()
+        self.log_stats()
+        self.reset_stats()
+        # Do not keep the finished session and its directory cache alive
+        self.session = None
+        self.folder_cache = {}
+
+    def restore_ignore(self):
+        if self.original_ignore is not None:
+            config['ignore'] = self.original_ignore
+            self.original_ignore = None
 
     def import_task_created_event(self, session, task):
+        self.prepare_session(session)
         if task.items and len(task.items) > 0:
             items_to_import = []
             for item in task.items:
-                if self.file_filter(item['path'], session.paths):
+                if self.item_filter(item['path']):
                     items_to_import.append(item)
             if len(items_to_import) > 0:
                 task.items = items_to_import
             else:
                 task.choice_flag = action.SKIP
         elif isinstance(task, SingletonImportTask):
-            if not self.file_filter(task.item['path'], session.paths):
+            if not self.item_filter(task.item['path']):
                 task.choice_flag = action.SKIP
 
+    def item_filter(self, full_path):
+        """Like file_filter, but for files of the current session only. The
+        verdict of the folder regex is cached per folder, so files of the
+        same folder cost a single folder evaluation.
+        """
+        start = timer()
+        matched_base_path = ''
+        for base_path in self.base_paths:
+            if full_path.startswith(base_path):
+                matched_base_path = base_path
+                break
+        path, file_name = os.path.split(full_path[len(matched_base_path):])
+
+        if path in self.folder_cache:
+            rejection = self.folder_cache[path]
+        else:
+            rejection = self.folder_rejection(path, self.singletons)
+            self.folder_cache[path] = rejection
+            if rejection:
+                self.rejected_folders[rejection] += 1
+        if not rejection:
+            rejection = self.file_rejection(file_name, self.singletons)
+        return self.count(rejection, start)
+
     def file_filter(self, full_path, base_paths):
         """Checks if the configured regular expressions allow the import of the
         file given in full_path.
         """
+        start = timer()
         # The folder regex only checks the folder names starting from the
         # longest base path. Find this folder.
         matched_base_path = ''
@@ -107,50 +417,116 @@ class RegexFileFilterPlugin(BeetsPlugin):
                 matched_base_path = base_path
         relative_path = full_path[len(matched_base_path):]
 
-        if os.path.isdir(full_path):
+        if self.session is not None:
+            is_dir = dircache.for_session(self.session).is_dir(full_path)
+        else:
+            is_dir = os.path.isdir(syspath(full_path))
+        if is_dir:
             path = relative_path
             file_name = None
         else:
             path, file_name = os.path.split(relative_path)
-        path, folder_name = os.path.split(path)
 
-        import_config = dict(config['import'])
-        if 'singletons' not in import_config or not import_config[
-            'singletons']:
-            # Album
-
-            # Folder
-            while len(folder_name) > 0:
-                matched = self.folder_name_album_regex.match(
-                    folder_name) is not None
-                matched = not matched if self.invert_folder_album_result else matched
-                if not matched:
-                    return False
-                path, folder_name = os.path.split(path)
-
-            # File
-            matched = self.file_name_album_regex.match(
-                file_name) is not None
-            matched = not matched if self.invert_file_album_result else matched
-            if not matched:
-                return False
-            return True
+        singletons = bool(config['import']['singletons'].get())
+        rejection = self.folder_rejection(path, singletons)
+        if rejection:
+            self.rejected_folders[rejection] += 1
+        else:
+            rejection = self.file_rejection(file_name, singletons)
+        return self.count(rejection, start)
+
+    def count(self, rejection, start):
+        """Updates the statistics for a checked file. Returns True if the
+        file is allowed."""
+        self.checked_files += 1
+        if rejection:
+            self.rejected_files[rejection] += 1
+        self.filter_time += timer() - start
+        return not rejection
+
+    def folder_filter(self, path, singletons):
+        """Checks if the folder regex of the given mode allows all folder
+        names of path.
+        """
+        return not self.folder_rejection(path, singletons)
+
+    def file_name_filter(self, file_name, singletons):
+        """Checks if the file regex of the given mode allows the file name."""
+        return not self.file_rejection(file_name, singletons)
+
+    def folder_rejection(self, path, singletons):
+        """Returns the name of the pattern rejecting a folder name of path
+        or None if all folder names are allowed.
+        """
+        if singletons:
+            regex = self.folder_name_singleton_regex
+            invert = self.invert_folder_singleton_result
+            rules = self.folder_singleton_rules
         else:
-            # Singleton
-
-            # Folder
-            while len(folder_name) > 0:
-                matched = self.folder_name_singleton_regex.match(
-                    folder_name) is not None
-                matched = not matched if self.invert_folder_singleton_result else matched
-                if not matched:
-                    return False
-                path, folder_name = os.path.split(path)
-
-            # File
-            matched = self.file_name_singleton_regex.match(
-                file_name) is not None
-            matched = not matched if self.invert_file_singleton_result else matched
+            regex = self.folder_name_album_regex
+            invert = self.invert_folder_album_result
+            rules = self.folder_album_rules
+
+        path, folder_name = os.path.split(path)
+        while len(folder_name) > 0:
+            matched = regex.match(folder_name) is not None
+            matched = not matched if invert else matched
             if not matched:
-                return False
-            return True
+                return u'folder_name_regex ({0})'.format(
+                    u'singleton' if singletons else u'album')
+            rule = rules.match(folder_name)
+            if rule and not rule.include:
+                return unicode(rule)
+            path, folder_name = os.path.split(path)
+        return None
+
+    def file_rejection(self, file_name, singletons):
+        """Returns the name of the pattern rejecting the file name or None if
+        it is allowed.
+        """
+        if singletons:
+            regex = self.file_name_singleton_regex
+            invert = self.invert_file_singleton_result
+            rules = self.file_singleton_rules
+        else:
+            regex = self.file_name_album_regex
+            invert = self.invert_file_album_result
+            rules = self.file_album_rules
+
+        matched = regex.match(file_name) is not None
+        matched = not matched if invert else matched
+        if not matched:
+            return u'file_name_regex ({0})'.format(
+                u'singleton' if singletons else u'album')
+        rule = rules.match(file_name)
+        if rule and not rule.include:
+            return unicode(rule)
+        return None
+
+    def reset_stats(self):
+        self.checked_files = 0
+        self.filter_time = 0.0
+        self.rejected_files = Counter()
+        self.rejected_folders = Counter()
+
+    def get_stats(self):
+        return {'checked_files': self.checked_files,
+                'filter_time': self.filter_time,
+                'rejected_files': dict(self.rejected_files),
+                'rejected_folders': dict(self.rejected_folders)}
+
+    def log_stats(self):
+        """Sends the statistics as the regexfilefilter_stats event and logs a
+        summary if the stats option is set."""
+        if not self.checked_files:
+            return
+        stats = self.get_stats()
+        plugins.send('regexfilefilter_stats', stats=stats)
+        if not self.config['stats'].get(bool):
+            return
+        self._log.info(u'checked {0} files in {1:.0f} ms, rejected {2}',
+                       self.checked_files, self.filter_time * 1000,
+                       sum(self.rejected_files.values()))
+        for pattern, files in sorted(self.rejected_files.items()):
+            self._log.info(u'  {0}: {1} files, {2} folders', pattern, files,
+                           self.rejected_folders[pattern])
@@ -0,0 +1,101 @@
+# This file is part of beets.
+# Copyright 2016, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+"""Measures the cost per item of writing the fields of the dirfields
+plugin, once with a transaction per item like the plugin used to do and once
+with the single transaction per task the import stage uses now.
+
+Usage (from the root of the repository):
+
+    python -m benchmark.bench_dirfields [-n ALBUMS] [-t TRACKS]
+"""
+import json
+import optparse
+import os
+import shutil
+import tempfile
+import time
+
+from beets.library import Item, Library
+
+from beetsplug.dirfields import DirFieldsPlugin, split_path
+
+
+class Session(object):
+    def __init__(self, lib):
+        self.lib = lib
+
+
+class Task(object):
+    def __init__(self, items, album):
+        self.items = items
+        self.album = album
+
+
+def create_tasks(lib, albums, tracks):
+    """Adds albums to the library and returns an import task for each."""
+    tasks = []
+    for i in range(albums):
+        items = [Item(path=os.path.join(b'/music', b'Artist %d' % (i % 50),
+                                        b'Album %d' % i, b'%02d - track.mp3' % j),
+                      title=u'Track %d' % j, track=j)
+                 for j in range(tracks)]
+        album = lib.add_album(items)
+        tasks.append(Task(items, album))
+    return tasks
+
+
+def store_each(plugin, session, task):
+    """Writes the fields the way the plugin did before, with a transaction
+    per item."""
+    for item in task.items + [task.album]:
+        dirs = split_path(item.path)
+        item.update(dict(('dir%i' % idx, name)
+                         for idx, name in enumerate(dirs)))
+        item.store()
+
+
+def time_stage(stage, plugin, session, tasks):
+    start = time.time()
+    for task in tasks:
+        stage(plugin, session, task)
+    items = sum(len(task.items) + 1 for task in tasks)
+    return (time.time() - start) / items
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--albums', type='int', default=200,
+                      help='number of albums')
+    parser.add_option('-t', '--tracks', type='int', default=12,
+                      help='number of tracks per album')
+    opts, args = parser.parse_args()
+
+    plugin = DirFieldsPlugin()
+    directory = tempfile.mkdtemp()
+    try:
+        result = {'albums': opts.albums, 'tracks': opts.tracks}
+        for name, stage in [('per_item', store_each),
+                            ('per_task', DirFieldsPlugin.stage)]:
+            lib = Library(os.path.join(directory, name + '.db'))
+            session = Session(lib)
+            tasks = create_tasks(lib, opts.albums, opts.tracks)
+            result[name + '_ms_per_item'] = \
+                time_stage(stage, plugin, session, tasks) * 1000
+    finally:
+        shutil.rmtree(directory)
+    print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# This file is part of beets.
+# Copyright 2016, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+"""Measures the import hooks of autosingleton, notagain, regexfilefilter,
+dirfields and the multipletaskcreated chain on a synthetic music tree.
+
+Usage (from the root of the repository):
+
+    python -m benchmark.bench_import [-a ARTISTS] [-n ALBUMS] [-t TRACKS]
+                                     [-m MISC] [-o OVERLAP] [-c CHAIN]
+
+The tree is created in a temporary directory: ARTISTS folders holding
+ALBUMS album folders with TRACKS numbered files each, plus MISC folders
+named misc with TRACKS unnumbered files. The files are empty; the items of
+the tasks are built in memory, like the importer would after reading the
+tags. OVERLAP is the fraction of the albums added to the library up front.
+
+Each hook runs in a forked child on fresh tasks with an empty directory
+cache, so the memory used by one hook does not count for the next. Peak
+memory is the peak resident size of the child, which starts at the size of
+the parent at the fork; memory growth is how much the peak grew while the
+hook ran. regexfilefilter is configured with the rules of
+bench_regexfilefilter. The result is printed as one line of JSON.
+"""
+import json
+import optparse
+import os
+import resource
+import shutil
+import tempfile
+import traceback
+from functools import partial
+from timeit import default_timer as timer
+
+from beets import config
+from beets.importer import ImportTask
+from beets.library import Item, Library
+
+from beetsplug.autosingleton import AutoSingletonPlugin
+from beetsplug.dirfields import DirFieldsPlugin
+from beetsplug.multipletaskcreated import MultipleTaskCreated
+from beetsplug.notagain import NotAgain
+from beetsplug.regexfilefilter import RegexFileFilterPlugin
+
+from benchmark.bench_regexfilefilter import RULES
+
+CHAINABLE = {
+    'autosingleton': AutoSingletonPlugin,
+    'notagain': NotAgain,
+}
+
+
+class Session(object):
+    """The parts of an import session used by the plugins."""
+    def __init__(self, lib, paths):
+        self.lib = lib
+        self.paths = paths
+
+    def already_imported(self, toppath, paths):
+        return False
+
+
+def create_tree(root, artists, albums, tracks, misc):
+    """Creates the folders and files and returns a list of
+    (folder, [(path, tags)]) for each folder."""
+    folders = []
+
+    def create_folder(folder, names, tags):
+        os.makedirs(folder)
+        files = []
+        for i, name in enumerate(names):
+            path = os.path.join(folder, name)
+            open(path, 'wb').close()
+            files.append((path, dict(tags, title=u'Track %d' % i,
+                                     track=i + 1)))
+        folders.append((folder, files))
+
+    for a in range(artists):
+        artist = b'Artist %d' % a
+        for b in range(albums):
+            create_folder(os.path.join(root, artist, b'Album %d' % b),
+                          [b'%02d - Track.mp3' % (i + 1)
+                           for i in range(tracks)],
+                          {'artist': artist.decode('utf-8'),
+                           'album': u'Album %d %d' % (a, b)})
+    for m in range(misc):
+        create_folder(os.path.join(root, b'Various %d' % m, b'misc'),
+                      [b'Track %d.mp3' % i for i in range(tracks)],
+                      {'artist': u'Various', 'album': u''})
+    return folders
+
+
+def create_tasks(root, folders):
+    return [ImportTask(root, [folder],
+                       [Item(path=path, **tags) for path, tags in files])
+            for folder, files in folders]
+
+
+def peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_forked(function):
+    """Runs function in a forked child and returns its result, which must
+    be serializable to JSON, the peak resident size of the child in kB and
+    how much it grew while the function ran."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            before = peak_memory_kb()
+            result = function()
+            after = peak_memory_kb()
+            with os.fdopen(write_fd, 'wb') as f:
+                json.dump([result, after, after - before], f)
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        # Leave without running the cleanup of the parent
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('benchmark child failed')
+    return json.loads(data)
+
+
+def time_hook(hook, lib, root, tasks):
+    """Runs the hook for all tasks. Returns the elapsed time and the number
+    of tasks returned."""
+    session = Session(lib, [root])
+    tasks_out = 0
+    start = timer()
+    for task in tasks:
+        result = hook(session, task)
+        tasks_out += 1 if result is None else len(list(result))
+    return timer() - start, tasks_out
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-a', '--artists', type='int', default=20,
+                      help='number of artist folders')
+    parser.add_option('-n', '--albums', type='int', default=10,
+                      help='number of albums per artist')
+    parser.add_option('-t', '--tracks', type='int', default=12,
+                      help='number of tracks per folder')
+    parser.add_option('-m', '--misc', type='int', default=5,
+                      help='number of misc folders')
+    parser.add_option('-o', '--overlap', type='float', default=0.5,
+                      help='fraction of the albums already in the library')
+    parser.add_option('-c', '--chain', default='autosingleton,notagain',
+                      help='plugins chained by multipletaskcreated')
+    opts, args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        root = os.path.join(directory, b'music')
+        config.read(user=False)
+        config['directory'] = root
+        config['notagain']['state_file'] = os.path.join(directory,
+                                                        b'notagain.pickle')
+        config['regexfilefilter'] = {'rules': RULES}
+
+        folders = create_tree(root, opts.artists, opts.albums, opts.tracks,
+                              opts.misc)
+        files = sum(len(files) for _, files in folders)
+        lib_path = os.path.join(directory, b'library.db')
+        lib = Library(lib_path)
+        album_folders = folders[:opts.artists * opts.albums]
+        with lib.transaction():
+            for task in create_tasks(
+                    root, album_folders[:int(len(album_folders) *
+                                             opts.overlap)]):
+                lib.add_album(task.items)
+
+        result = {'artists': opts.artists, 'albums': opts.albums,
+                  'tracks': opts.tracks, 'misc': opts.misc,
+                  'overlap': opts.overlap, 'files': files, 'hooks': {}}
+
+        def report(name, function):
+            (elapsed, tasks_out), peak, growth = run_forked(function)
+            result['hooks'][name] = {
+                'seconds': elapsed,
+                'files_per_second': files / elapsed if elapsed else None,
+                'tasks_in': len(folders),
+                'tasks_out': tasks_out,
+                'peak_memory_kb': peak,
+                'memory_growth_kb': growth,
+            }
+
+        # The children open the library again rather than sharing the
+        # connection of the parent
+        def plugin_hook(plugin_class):
+            plugin = plugin_class()
+            return time_hook(plugin.import_task_created_event,
+                             Library(lib_path), root,
+                             create_tasks(root, folders))
+
+        for name, plugin_class in [('autosingleton', AutoSingletonPlugin),
+                                   ('notagain', NotAgain),
+                                   ('regexfilefilter',
+                                    RegexFileFilterPlugin)]:
+            report(name, partial(plugin_hook, plugin_class))
+
+        def dirfields_hook():
+            # dirfields writes to the items, so they need to be in a library
+            dirfields_lib = Library(os.path.join(directory, b'dirfields.db'))
+            tasks = create_tasks(root, folders)
+            with dirfields_lib.transaction():
+                for task in tasks:
+                    task.album = dirfields_lib.add_album(task.items)
+            return time_hook(DirFieldsPlugin().stage, dirfields_lib, root,
+                             tasks)
+        report('dirfields', dirfields_hook)
+
+        chain_names = [name.strip() for name in opts.chain.split(',')]
+
+        def chain_hook():
+            chain = MultipleTaskCreated()
+            for name in chain_names:
+                plugin = CHAINABLE[name]()
+                plugin.chained = True
+                chain.plugins.append(plugin)
+            return time_hook(chain.import_task_created_event,
+                             Library(lib_path), root,
+                             create_tasks(root, folders))
+        report('multipletaskcreated', chain_hook)
+        result['chain'] = chain_names
+    finally:
+        shutil.rmtree(directory)
+    print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# This file is part of beets.
+# Copyright 2015, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+"""Measures the cost of the content fingerprint of the notagain plugin per
+file and compares it to the time the autotagger needs for the same files.
+
+Usage (from the root of the repository):
+
+    python -m benchmark.bench_notagain [-n COUNT] [-s SIZE_MB] [-k KB]
+                                       [--autotag FILE ...]
+
+Without --autotag, synthetic files with ID3 tags are fingerprinted. With
+--autotag, the given audio files are fingerprinted and matched by the
+autotagger (this needs network access to MusicBrainz).
+"""
+import json
+import optparse
+import os
+import shutil
+import tempfile
+import time
+
+from beetsplug.notagain import content_fingerprint
+
+
+def create_files(directory, count, size):
+    """Creates count files of the given size looking like MP3 files with an
+    ID3v2 and an ID3v1 tag."""
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, 'track_{0}.mp3'.format(i))
+        with open(path, 'wb') as f:
+            # ID3v2.4 header announcing a 1 KB tag
+            f.write(b'ID3\x04\x00\x00\x00\x00\x08\x00')
+            f.write(b'\x00' * 1024)
+            f.write(os.urandom(size))
+            f.write(b'TAG' + b'\x00' * 125)
+        paths.append(path)
+    return paths
+
+
+def time_fingerprints(paths, chunk_size):
+    start = time.time()
+    for path in paths:
+        content_fingerprint(path, chunk_size)
+    return (time.time() - start) / len(paths)
+
+
+def time_autotagger(paths):
+    from beets import autotag
+    from beets.library import Item
+
+    start = time.time()
+    for path in paths:
+        autotag.tag_item(Item.from_path(path))
+    return (time.time() - start) / len(paths)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type='int', default=200,
+                      help='number of synthetic files')
+    parser.add_option('-s', '--size', type='float', default=8,
+                      help='size of each synthetic file in MB')
+    parser.add_option('-k', '--kb', type='int', default=64,
+                      help='KB hashed at each end of the audio data')
+    parser.add_option('--autotag', action='store_true', default=False,
+                      help='use the files given as arguments and run the '
+                           'autotagger on them')
+    opts, args = parser.parse_args()
+
+    result = {'chunk_kb': opts.kb}
+    if opts.autotag:
+        result['files'] = len(args)
+        result['fingerprint_ms_per_file'] = \
+            time_fingerprints(args, opts.kb * 1024) * 1000
+        result['autotag_ms_per_file'] = time_autotagger(args) * 1000
+    else:
+        directory = tempfile.mkdtemp()
+        try:
+            paths = create_files(directory, opts.count,
+                                 int(opts.size * 1024 * 1024))
+            result['files'] = len(paths)
+            result['file_size_mb'] = opts.size
+            result['fingerprint_ms_per_file'] = \
+                time_fingerprints(paths, opts.kb * 1024) * 1000
+        finally:
+            shutil.rmtree(directory)
+    print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# This file is part of beets.
+# Copyright 2015, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+"""Measures the throughput of the regexfilefilter plugin over a synthetic
+tree of paths. The tree only exists in memory; no file is touched.
+
+Usage (from the root of the repository):
+
+    python -m benchmark.bench_regexfilefilter [-n COUNT] [--legacy]
+
+By default the filter is configured using rules; with --legacy the same
+filter is expressed using single alternation patterns.
+"""
+import json
+import optparse
+import os
+import time
+
+from beets import config
+
+from beetsplug.regexfilefilter import RegexFileFilterPlugin
+
+BASE_PATH = b'/inbox'
+EXTENSIONS = [b'.mp3', b'.flac', b'.jpg', b'.png', b'.cue', b'.log', b'.nfo']
+SUB_FOLDERS = [b'', b'', b'', b'CD1', b'scans', b'video']
+
+RULES = [
+    {'exclude_folder': 'scans$'},
+    {'exclude_folder': 'video$'},
+    {'exclude_folder_prefix': '_'},
+    {'exclude_file_suffix': '.jpg'},
+    {'exclude_file_suffix': '.png'},
+    {'exclude_file_suffix': '.nfo'},
+    {'include_file': r'.*\.(mp3|flac|m4a|ogg)$'},
+    {'exclude_file': '.*'},
+]
+LEGACY = {
+    'folder_name_regex': r'(scans|video|_.*)$',
+    'invert_folder_result': True,
+    'file_name_regex': r'.*\.(mp3|flac|m4a|ogg)$',
+}
+
+
+def synthetic_paths(count, files_per_folder=12):
+    """Yields count paths of a tree like /inbox/artist/album/[sub/]file."""
+    for i in range(count):
+        folder = i // files_per_folder
+        sub_folder = SUB_FOLDERS[folder % len(SUB_FOLDERS)]
+        path = os.path.join(BASE_PATH, b'artist {0}'.format(folder // 10),
+                            b'album {0}'.format(folder), sub_folder)
+        yield os.path.join(path, b'{0:02d} - track{1}'.format(
+            i % files_per_folder, EXTENSIONS[i % len(EXTENSIONS)]))
+
+
+class Session(object):
+    paths = [BASE_PATH]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type='int', default=1000000,
+                      help='number of paths')
+    parser.add_option('--legacy', action='store_true', default=False,
+                      help='use the *_name_regex options instead of rules')
+    opts, _ = parser.parse_args()
+
+    config['import']['singletons'] = False
+    config['regexfilefilter'] = LEGACY if opts.legacy else {'rules': RULES}
+    plugin = RegexFileFilterPlugin()
+    plugin.prepare_session(Session())
+
+    paths = list(synthetic_paths(opts.count))
+    start = time.time()
+    accepted = sum(1 for path in paths if plugin.item_filter(path))
+    duration = time.time() - start
+
+    print(json.dumps({'mode': 'legacy' if opts.legacy else 'rules',
+                      'paths': len(paths),
+                      'accepted': accepted,
+                      'seconds': duration,
+                      'paths_per_sec': len(paths) / duration},
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
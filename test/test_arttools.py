@@ -12,11 +12,18 @@
 # The above copyright notice and this permission notice shall be
 # included in all copies or substantial portions of the Software.
 
+import json
 import os
 import shutil
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from PIL import Image
 
 from beets import config, util
+from beets.plugins import find_plugins
 import beetsplug
 
 from test import _common
@@ -397,3 +404,287 @@ class ArtToolsPluginTest(_common.TestCase, TestHelper):
         config['arttools']['collect_extract'] = True
         self.run_command('collectart')
         self.assertExists(os.path.join(album.path, 'extracted.png'))
+
+
+class StubArtHandler(BaseHTTPRequestHandler):
+    """Serves the test resources. /slow/<file> sends the file
+    in small pieces with a delay between them, /trickle/<file> sends a
+    single byte at a time with a longer delay."""
+    def do_GET(self):
+        slow = self.path.startswith('/slow/')
+        trickle = self.path.startswith('/trickle/')
+        paths = [os.path.join(rsrc, os.path.basename(self.path))
+                 for rsrc in [RSRC, _common.RSRC]]
+        paths = [path for path in paths if os.path.isfile(path)]
+        if not paths:
+            self.send_error(404)
+            return
+        path = paths[0]
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if not slow and not trickle:
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if trickle:
+            try:
+                for i in range(len(content)):
+                    self.wfile.write(content[i:i + 1])
+                    self.wfile.flush()
+                    time.sleep(0.2)
+            except IOError:
+                # The client gave up
+                pass
+        elif slow:
+            try:
+                for i in range(0, len(content), 16):
+                    self.wfile.write(content[i:i + 16])
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            except IOError:
+                # The client gave up
+                pass
+        else:
+            self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebChooserTest(_common.TestCase, TestHelper):
+    """ Test the web chooser of the arttools plugin
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        config['pluginpath'] = [os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), "..", "beetsplug")]
+        beetsplug.__path__ = config['pluginpath'].get() + beetsplug.__path__
+
+    def setUp(self):
+        self.setup_beets()
+        self.load_plugins('arttools')
+        from beetsplug.arttools import webchooser
+        plugin = [p for p in find_plugins() if p.name == 'arttools'][0]
+        webchooser.app.config['lib'] = self.lib
+        webchooser.app.config['plugin'] = plugin
+        webchooser.app.config['log'] = plugin._log
+        webchooser.app.config['collect_tasks'] = []
+        webchooser.app.config['jobs'] = {}
+        webchooser.app.config['probe_pool'] = ThreadPool(2)
+        webchooser.app.config['thumb_dir'] = os.path.join(self.temp_dir,
+                                                          'thumbs')
+        self.client = webchooser.app.test_client()
+
+    def tearDown(self):
+        self.unload_plugins()
+        self.teardown_beets()
+
+    def assertSize(self, image_path, width, height):
+        im = Image.open(util.syspath(image_path))
+        self.assertEqual(im.size, (width, height))
+
+    def __create_album(self, album, art_width, art_height):
+        album = self.add_album(albumartist=u'Artist', artist=u'Artist',
+                               album=album)
+        for item in album.items():
+            item.path = os.path.join(_common.RSRC, 'full.mp3')
+            item.move(copy=True)
+            item.store()
+        art_filename = '{0}x{1}.png'.format(art_width, art_height)
+        shutil.copy(os.path.join(RSRC, art_filename),
+                    os.path.join(album.path, 'cover.png'))
+        return album
+
+    def test_get_albums(self):
+        albums = [self.__create_album(u'First', 200, 200),
+                  self.__create_album(u'Second', 300, 300)]
+
+        response = self.client.post('/albums', data={
+            'ids': '{0},{1},4711'.format(albums[1].id, albums[0].id)})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([a['id'] for a in data],
+                         [albums[1].id, albums[0].id])
+        self.assertEqual(data[0]['art_files'][0]['width'], 300)
+        self.assertEqual(data[1]['art_files'][0]['width'], 200)
+
+        response = self.client.post('/albums', data={'ids': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+        ids = ','.join([str(albums[0].id)] * 5000)
+        response = self.client.post('/albums', data={'ids': ids})
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_art_file_conditional(self):
+        album = self.__create_album(u'Album', 200, 200)
+
+        response = self.client.get('/art/{0}/cover.png'.format(album.id))
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+        response = self.client.get('/art/{0}/cover.png'.format(album.id),
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/art/{0}/cover.png'.format(album.id),
+                                   headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(response.data), 10)
+
+    def test_static_file_fingerprint(self):
+        from beetsplug.arttools import webchooser
+        with webchooser.app.test_request_context():
+            url = webchooser.flask.url_for('static',
+                                           filename='js/webchooser.js')
+        self.assertIn('?v=', url)
+
+        response = self.client.get(url,
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+    def test_get_thumb_file(self):
+        album = self.__create_album(u'Album', 300, 300)
+
+        response = self.client.get('/thumb/{0}/cover.png?size=100'.format(
+            album.id))
+        self.assertEqual(response.status_code, 200)
+        im = Image.open(BytesIO(response.data))
+        self.assertEqual(im.format, 'JPEG')
+        self.assertEqual(im.size, (100, 100))
+        self.assertEqual(len(os.listdir(os.path.join(self.temp_dir,
+                                                     'thumbs'))), 1)
+
+        response = self.client.get('/thumb/{0}/missing.png'.format(album.id))
+        self.assertEqual(response.status_code, 404)
+
+    def __start_stub_server(self):
+        server = HTTPServer(('127.0.0.1', 0), StubArtHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{0}'.format(server.server_port)
+
+    def test_download_art(self):
+        from beetsplug.arttools import webchooser
+        album = self.__create_album(u'Album', 200, 200)
+        base_url = self.__start_stub_server()
+
+        file_name = webchooser.download_art(base_url + '/300x300.png',
+                                            album.path, 1024 * 1024, 10)
+        self.assertEqual(file_name, 'uploaded.png')
+        self.assertSize(os.path.join(album.path, file_name), 300, 300)
+
+        with self.assertRaises(webchooser.ArtLoadError):
+            webchooser.download_art(base_url + '/300x300.png', album.path,
+                                    100, 10)
+        with self.assertRaises(webchooser.ArtLoadError):
+            webchooser.download_art(base_url + '/slow/300x300.png',
+                                    album.path, 1024 * 1024, 0.2)
+        with self.assertRaises(webchooser.ArtLoadError):
+            webchooser.download_art(base_url + '/full.mp3', album.path,
+                                    1024 * 1024, 10)
+        with self.assertRaises(webchooser.ArtLoadError):
+            webchooser.download_art(base_url + '/missing.png', album.path,
+                                    1024 * 1024, 10)
+        self.assertEqual(sorted(os.listdir(album.path)),
+                         sorted(['cover.png', 'uploaded.png'] +
+                                [os.path.basename(i.path)
+                                 for i in album.items()]))
+
+    def test_download_art_trickle(self):
+        from beetsplug.arttools import webchooser
+        album = self.__create_album(u'Album', 200, 200)
+        base_url = self.__start_stub_server()
+
+        # Every read gets a byte within the timeout of requests, only the
+        # total time is exceeded.
+        start = time.time()
+        with self.assertRaises(webchooser.ArtLoadError):
+            webchooser.download_art(base_url + '/trickle/300x300.png',
+                                    album.path, 1024 * 1024, 1)
+        self.assertLess(time.time() - start, 5)
+        self.assertNotIn('uploaded.png', os.listdir(album.path))
+
+    def test_load_art_job(self):
+        album = self.__create_album(u'Album', 200, 200)
+        base_url = self.__start_stub_server()
+
+        response = self.client.get('/loadArt/{0}/{1}/200x300.png'.format(
+            album.id, base_url))
+        data = json.loads(response.data)
+        self.assertEqual(data['result'], 'ok')
+
+        self.assertEqual(self.__wait_for_job(data['job'])['state'], 'done')
+        self.assertSize(os.path.join(album.path, 'uploaded.png'), 200, 300)
+
+    def __wait_for_job(self, job_id):
+        for _ in range(100):
+            job = json.loads(self.client.get('/job/' + job_id).data)
+            if job['state'] != 'running':
+                return job
+            time.sleep(0.1)
+        self.fail('Job {0} did not finish'.format(job_id))
+
+    def test_accept_art_query(self):
+        state_file = os.path.join(self.temp_dir, 'accept.json')
+        config['arttools']['accept_state_file'] = state_file
+        albums = [self.__create_album(u'First', 200, 200),
+                  self.__create_album(u'Second', 100, 100)]
+        shutil.copy(os.path.join(RSRC, '300x300.png'),
+                    os.path.join(albums[0].path, 'extracted.png'))
+
+        response = self.client.get('/acceptArtQuery/')
+        data = json.loads(response.data)
+        self.assertEqual(data['result'], 'ok')
+        job = self.__wait_for_job(data['job'])
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['progress'], 2)
+        self.assertFalse(os.path.exists(state_file))
+
+        first = self.lib.get_album(albums[0].id)
+        self.assertSize(first.artpath, 300, 300)
+        self.assertEqual(sorted(os.listdir(first.path)),
+                         sorted(['cover.png'] +
+                                [os.path.basename(i.path)
+                                 for i in first.items()]))
+        self.assertSize(self.lib.get_album(albums[1].id).artpath, 100, 100)
+
+    def test_accept_art_query_exclusive(self):
+        from beetsplug.arttools import webchooser
+        state_file = os.path.join(self.temp_dir, 'accept.json')
+        config['arttools']['accept_state_file'] = state_file
+        with open(state_file, 'w') as f:
+            json.dump([4711], f)
+        album = self.__create_album(u'Album', 200, 200)
+        webchooser.app.config['jobs']['running'] = {
+            'id': 'running', 'name': u'accept', 'state': 'running',
+            'started': time.time()}
+
+        response = self.client.get('/acceptArtQuery/')
+        data = json.loads(response.data)
+        self.assertEqual(data['result'], 'failed')
+        self.assertIsNone(webchooser.start_accept_job([album.id]))
+        # The state of the running job is left alone
+        with open(state_file) as f:
+            self.assertEqual(json.load(f), [4711])
+
+    def test_resume_accept_art(self):
+        from beetsplug.arttools import webchooser
+        state_file = os.path.join(self.temp_dir, 'accept.json')
+        config['arttools']['accept_state_file'] = state_file
+        album = self.__create_album(u'Album', 200, 200)
+        with open(state_file, 'w') as f:
+            json.dump([album.id], f)
+
+        webchooser.resume_pending_accepts()
+        job_id = webchooser.app.config['jobs'].keys()[0]
+        self.assertEqual(self.__wait_for_job(job_id)['state'], 'done')
+        self.assertFalse(os.path.exists(state_file))
+        self.assertSize(self.lib.get_album(album.id).artpath, 200, 200)
@@ -0,0 +1,237 @@
+# This file is part of beets.
+# Copyright 2016, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+import os
+import shutil
+from beets import config
+from beets.importer import ImportTask, SingletonImportTask
+from beets.library import Item
+from beets.util import confit, fnmatch_all
+import beetsplug
+from beetsplug import dircache
+from beetsplug.autosingleton import AutoSingletonPlugin, ClassifierRule, \
+    directory_features
+from test import _common
+from test.helper import TestHelper, capture_stdout
+
+
+class ClassifierRuleTest(_common.TestCase):
+    def test_parse(self):
+        rule = ClassifierRule.from_config({'subdirs': '>0',
+                                           'folder_name': 'misc',
+                                           'files': 3})
+        self.assertEqual(rule.conditions, [('files', '=', u'3'),
+                                           ('folder_name', '=', u'misc'),
+                                           ('subdirs', '>', 0.0)])
+
+    def test_invalid(self):
+        for rule_config in [{}, 'misc', ['subdirs'], {'subdirs': '>many'}]:
+            self.assertRaises(ValueError, ClassifierRule.from_config,
+                              rule_config)
+
+    def test_matches(self):
+        features = {'folder_name': u'misc', 'subdirs': 2, 'files': 3,
+                    'numbered_ratio': 0.5}
+        for conditions, expected in [
+                ({'folder_name': 'Misc'}, True),
+                ({'folder_name': 'other'}, False),
+                ({'subdirs': '>0'}, True),
+                ({'subdirs': '>=3'}, False),
+                ({'files': 3}, True),
+                ({'files': '!= 3'}, False),
+                ({'numbered_ratio': '<0.6'}, True),
+                ({'ext_flac': '>0'}, False),
+                ({'ext_flac': 0}, True),
+                ({'files': 'many'}, False),
+                ({'folder_name': 'misc', 'subdirs': 0}, False)]:
+            rule = ClassifierRule.from_config(conditions)
+            self.assertEqual(rule.matches(features), expected,
+                             u'{0}'.format(rule))
+
+
+class AutoSingletonPluginTest(_common.TestCase, TestHelper):
+    """ Test the autosingleton plugin
+    """
+
+    def setUp(self):
+        super(AutoSingletonPluginTest, self).setUp()
+        self.setup_beets()
+        config['pluginpath'] = [os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                                             "beetsplug")]
+        beetsplug.__path__ = config['pluginpath'].get() + beetsplug.__path__
+        self.import_dir = os.path.join(self.temp_dir, 'testsrcdir')
+
+    def tearDown(self):
+        self.teardown_beets()
+
+    def __create_files(self, *paths):
+        """Copies a test file to the given paths below the import
+        directory and returns the full paths."""
+        full_paths = []
+        for path in paths:
+            full_path = os.path.join(self.import_dir, *path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            shutil.copy(os.path.join(_common.RSRC, 'full.mp3'), full_path)
+            full_paths.append(full_path)
+        return full_paths
+
+    def test_invalid_rules(self):
+        config['autosingleton']['rules'] = [{'subdirs': '>many'}]
+        self.assertRaises(confit.ConfigError, AutoSingletonPlugin)
+        config['autosingleton']['rules'] = ['misc']
+        self.assertRaises(confit.ConfigError, AutoSingletonPlugin)
+
+    def test_item_features_not_cached(self):
+        paths = self.__create_files(('album', '01 - a.mp3'),
+                                    ('album', 'b.mp3'))
+        directory = os.path.dirname(paths[0])
+        items = [Item(path=path, album=u'album', artist=u'artist')
+                 for path in paths]
+        plugin = AutoSingletonPlugin()
+        cache = dircache.DirectoryCache()
+        features = plugin.get_features(directory, items, cache)
+        self.assertEqual(features['files'], 2)
+        self.assertEqual(features['unnumbered_mp3'], 1)
+        self.assertIsNotNone(plugin.classify(directory, items, cache))
+
+        # Another task of the same directory with other items
+        features = plugin.get_features(directory, items[:1], cache)
+        self.assertEqual(features['files'], 1)
+        self.assertEqual(features['unnumbered_mp3'], 0)
+        self.assertIsNone(plugin.classify(directory, items[:1], cache))
+
+        # The subdirectories are only listed again if the mtime changes
+        os.mkdir(os.path.join(directory, 'sub'))
+        stat = os.stat(directory)
+        os.utime(directory, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(plugin.get_features(directory, items[:1],
+                                             cache)['subdirs'], 0)
+        self.assertEqual(plugin.get_features(
+            directory, items[:1], dircache.DirectoryCache())['subdirs'], 1)
+
+    def test_directory_features(self):
+        items = [Item(path=os.path.join('/music', 'Misc', name),
+                      album=album, artist=u'artist')
+                 for name, album in [('01 - a.mp3', u'x'),
+                                     ('02 - b.flac', u'x'),
+                                     ('c.mp3', u'y')]]
+        features = directory_features(os.path.join('/music', 'Misc'), items,
+                                      ['sub'])
+        self.assertEqual(features['folder_name'], u'misc')
+        self.assertEqual(features['subdirs'], 1)
+        self.assertEqual(features['files'], 3)
+        self.assertEqual(features['numbered'], 2)
+        self.assertEqual(features['unnumbered_mp3'], 1)
+        self.assertEqual(features['ext_mp3'], 2)
+        self.assertEqual(features['ext_flac'], 1)
+        self.assertEqual(features['albums'], 2)
+        self.assertEqual(features['artists'], 1)
+
+    def test_clutter_regex(self):
+        names = ['.DS_Store', 'Thumbs.DB', '__MACOSX', 'Scans', 'scans',
+                 'cd1', '.hidden', 'x.DS_Store']
+        plugin = AutoSingletonPlugin()
+        for patterns in [[], ['.DS_Store', 'Thumbs.DB'], ['scan*'],
+                         ['__MACOSX', '.*', 'cd[0-9]', '?cans']]:
+            config['clutter'] = patterns
+            clutter = plugin.get_clutter_regex()
+            for name in names:
+                self.assertEqual(
+                    bool(clutter.match(os.path.normcase(name))),
+                    fnmatch_all([name], patterns),
+                    u'{0} {1}'.format(name, patterns))
+
+    def test_directory_listed_once(self):
+        paths = self.__create_files(('misc', 'a.mp3'), ('misc', 'b.mp3'))
+        directory = os.path.dirname(paths[0])
+        os.mkdir(os.path.join(directory, 'sub'))
+        items = [Item(path=path, title=u'title') for path in paths]
+
+        class Session(object):
+            pass
+
+        listed = []
+        listdir = os.listdir
+
+        def counting_listdir(path):
+            listed.append(path)
+            return listdir(path)
+        scandir = dircache.scandir
+        dircache.scandir = None
+        os.listdir = counting_listdir
+        try:
+            session = Session()
+            plugin = AutoSingletonPlugin()
+            for task_items in [items, items[:1], items[1:]]:
+                task = ImportTask(self.import_dir, [directory], task_items)
+                plugin.is_singleton(task, session)
+            # Another plugin of the session using the shared cache
+            cache = dircache.for_session(session)
+            self.assertEqual(cache.subdirectories(directory), ['sub'])
+            self.assertEqual(len(cache.entry_stats(directory)), 3)
+        finally:
+            os.listdir = listdir
+            dircache.scandir = scandir
+        self.assertEqual(listed, [directory])
+
+    def test_singletons_reuse_items(self):
+        paths = self.__create_files(('misc', 'a.mp3'), ('misc', 'b.mp3'),
+                                    ('misc', 'c.mp3'))
+        directory = os.path.dirname(paths[0])
+        items = [Item(path=path, title=u'title') for path in paths]
+        task = ImportTask(self.import_dir, [directory], items)
+
+        class Session(object):
+            def already_imported(self, toppath, paths):
+                return paths == [items[1].path]
+
+        def fail(*args, **kwargs):
+            raise AssertionError('file read again')
+        from_path, read = Item.__dict__['from_path'], Item.read
+        Item.from_path = classmethod(fail)
+        Item.read = fail
+        try:
+            tasks = AutoSingletonPlugin().import_task_created_event(
+                Session(), task)
+        finally:
+            Item.from_path = from_path
+            Item.read = read
+
+        self.assertEqual(len(tasks), 2)
+        for new_task, item in zip(tasks, [items[0], items[2]]):
+            self.assertIsInstance(new_task, SingletonImportTask)
+            self.assertIs(new_task.item, item)
+            self.assertEqual(new_task.toppath, self.import_dir)
+
+    def test_classify_command(self):
+        self.__create_files(('album', '01 - a.mp3'), ('album', '02 - b.mp3'),
+                            ('misc', '01 - a.mp3'),
+                            ('loose', 'a.mp3'))
+        self.load_plugins('autosingleton')
+        try:
+            with capture_stdout() as output:
+                self.run_command('autosingleton', self.import_dir)
+        finally:
+            self.unload_plugins()
+        lines = sorted(output.getvalue().splitlines())
+        self.assertEqual(lines, [
+            u'album      {0}'.format(os.path.join(self.import_dir, 'album')),
+            u'singletons {0} (unnumbered_mp3 > 0.0)'.format(
+                os.path.join(self.import_dir, 'loose')),
+            u'singletons {0} (folder_name = misc)'.format(
+                os.path.join(self.import_dir, 'misc')),
+        ])
+        # Nothing was imported
+        self.assertEqual(len(self.lib.items()), 0)
@@ -0,0 +1,120 @@
+# This file is part of beets.
+# Copyright 2016, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+import os
+import shutil
+import unittest
+from beets import config
+import beetsplug
+from beetsplug import dircache
+from beetsplug.autosingleton import AutoSingletonPlugin
+from beetsplug.multipletaskcreated import MultipleTaskCreated
+from beetsplug.regexfilefilter import RegexFileFilterPlugin
+from test import _common
+from test.helper import TestHelper
+
+
+class Session(object):
+    def __init__(self, paths):
+        self.paths = paths
+
+
+class DirectoryCacheTest(_common.TestCase, TestHelper):
+    """ Test the file system cache shared by the plugins
+    """
+
+    def setUp(self):
+        super(DirectoryCacheTest, self).setUp()
+        self.setup_beets()
+        config['pluginpath'] = [os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                                             "beetsplug")]
+        beetsplug.__path__ = config['pluginpath'].get() + beetsplug.__path__
+        self.import_dir = os.path.join(self.temp_dir, 'testsrcdir')
+        self.album_dir = os.path.join(self.import_dir, 'album')
+        os.makedirs(os.path.join(self.album_dir, 'scans'))
+        self.file_path = os.path.join(self.album_dir, 'a.mp3')
+        shutil.copy(os.path.join(_common.RSRC, 'full.mp3'), self.file_path)
+
+    def tearDown(self):
+        self.teardown_beets()
+
+    def test_counters(self):
+        cache = dircache.DirectoryCache()
+        self.assertEqual(cache.entries(self.album_dir),
+                         cache.entries(self.album_dir))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        self.assertTrue(cache.is_dir(self.album_dir))
+        self.assertTrue(cache.exists(self.album_dir))
+        self.assertFalse(cache.exists(os.path.join(self.album_dir, 'b.mp3')))
+        self.assertFalse(cache.exists(os.path.join(self.album_dir, 'b.mp3')))
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+        self.assertEqual(sorted(cache.subdirectories(self.album_dir)),
+                         ['scans'])
+        self.assertEqual(cache.split(self.file_path, os.path.split),
+                         (self.album_dir, 'a.mp3'))
+        cache.split(self.file_path, os.path.split)
+        self.assertEqual((cache.hits, cache.misses), (5, 4))
+
+        # Cleared entries are looked up again
+        cache.clear()
+        cache.entries(self.album_dir)
+        self.assertEqual((cache.hits, cache.misses), (5, 5))
+
+    def test_invalidate(self):
+        session = Session([self.import_dir])
+        cache = dircache.for_session(session)
+        self.assertIs(dircache.for_session(session), cache)
+        self.assertIsNot(dircache.for_session(Session([self.import_dir])),
+                         cache)
+
+        self.assertIs(dircache.invalidate(session), cache)
+        self.assertIsNone(dircache.invalidate(session))
+        self.assertIsNot(dircache.for_session(session), cache)
+
+    def test_shared_between_plugins(self):
+        session = Session([self.import_dir])
+        chain = MultipleTaskCreated()
+        list(chain.import_task_created_event(session, None))
+
+        # The first plugin lists the folders while pruning the walk, the
+        # second one finds the listing
+        config['regexfilefilter']['prune_walk'] = True
+        regexfilefilter = RegexFileFilterPlugin()
+        regexfilefilter.import_begin_event(session)
+        cache = dircache.for_session(session)
+        misses = cache.misses
+        self.assertEqual(cache.hits, 0)
+        self.assertGreater(misses, 0)
+        autosingleton = AutoSingletonPlugin()
+        self.assertEqual(autosingleton.get_subdirs(self.album_dir, cache),
+                         ['scans'])
+        # Only the mtime of the folder was new
+        self.assertEqual((cache.hits, cache.misses), (1, misses + 1))
+
+        # The cache of the session is dropped when the import ends, and the
+        # plugins do not keep the session
+        regexfilefilter.import_event(self.lib, [])
+        self.assertIsNone(regexfilefilter.session)
+        chain.import_event(self.lib, [])
+        self.assertIsNone(chain.session)
+        self.assertIsNone(dircache.invalidate(session))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
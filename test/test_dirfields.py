@@ -15,10 +15,21 @@
 import os
 from beets import config
 import beetsplug
+from beetsplug import dirfields
+from beets.library import Album, Item
+from beetsplug.dirfields import AlbumDirFieldQuery, DirFieldsPlugin, \
+    DirFieldQuery, parse_levels, split_path
 from test import _common
 from test.test_importer import ImportHelper, AutotagStub
 
 
+class Options(object):
+    """The options of the dirfields command."""
+    def __init__(self, jobs=1, force=False):
+        self.jobs = jobs
+        self.force = force
+
+
 class DirFieldsPluginTest(_common.TestCase, ImportHelper):
     """ Test the dir field plugin
     """
@@ -112,3 +123,207 @@ class DirFieldsPluginTest(_common.TestCase, ImportHelper):
 
     def test_fields_levels_empty(self):
         self.__run_fields_levels('')
+
+    def test_parse_levels(self):
+        self.assertEqual(parse_levels('6,-1,6,4-3,8-'),
+                         (frozenset([0, 1, 3, 4, 6]), 8))
+        self.assertEqual(parse_levels(''), (frozenset(), 0))
+
+    def test_split_path(self):
+        self.assertEqual(split_path(self.import_dir),
+                         self.import_dir.split(os.path.sep))
+
+    def test_stage_single_transaction(self):
+        config['dirfields']['index'] = True
+        items = [Item(path=os.path.join(self.import_dir, 'album',
+                                        '%i.mp3' % i), title=u'title')
+                 for i in range(3)]
+        album = self.lib.add_album(items)
+        plugin = DirFieldsPlugin()
+        plugin.create_index(self.lib)
+
+        class Task(object):
+            pass
+        task = Task()
+        task.items = items
+        task.album = album
+
+        class Session(object):
+            lib = self.lib
+
+        class CountingConnection(object):
+            def __init__(self, connection):
+                self.connection = connection
+
+            def __getattr__(self, name):
+                return getattr(self.connection, name)
+
+            def commit(self):
+                commits.append(True)
+                self.connection.commit()
+
+        commits = []
+        connection = self.lib._connection()
+        self.lib._connection = lambda: CountingConnection(connection)
+        try:
+            plugin.stage(Session(), task)
+        finally:
+            del self.lib._connection
+        self.assertEqual(len(commits), 1)
+
+        dirs = split_path(items[0].path)
+        for item in items:
+            item = self.lib.get_item(item.id)
+            self.assertEqual(item['dir%i' % (len(dirs) - 2)], dirs[-2])
+        self.assertEqual(self.lib.get_album(album.id)['dir%i' %
+                                                      (len(dirs) - 2)],
+                         dirs[-2])
+
+    def test_backfill(self):
+        config['dirfields']['levels'] = '1-'
+        config['dirfields']['dir2'] = 'foo'
+        path = os.path.join(self.import_dir, 'track.mp3')
+        item = Item(path=path, title=u'title')
+        self.lib.add(item)
+
+        plugin = DirFieldsPlugin()
+        plugin.backfill_command(self.lib, Options(), [])
+
+        dirs = split_path(path)
+        item = self.lib.get_item(item.id)
+        self.assertNotIn('dir0', item)
+        self.assertEqual(item['dir1'], dirs[1])
+        self.assertEqual(item['foo'], dirs[2])
+        self.assertEqual(item['dir%i' % (len(dirs) - 1)], 'track.mp3')
+
+        chunk = [(item.id, {'dir1': dirs[1], 'foo': dirs[2]})]
+        self.assertEqual(plugin.store_fields(self.lib, chunk), 0)
+
+    def test_item_chunks(self):
+        for i in range(5):
+            self.lib.add(Item(path=os.path.join(self.import_dir,
+                                                '%i.mp3' % i),
+                              title=u'title %i' % i))
+        self.lib.add(Item(path=os.path.join(self.import_dir, 'other.mp3'),
+                          title=u'other'))
+        plugin = DirFieldsPlugin()
+        chunk_size = dirfields.BACKFILL_CHUNK_SIZE
+        dirfields.BACKFILL_CHUNK_SIZE = 2
+        try:
+            # A regular expression query cannot be done in SQL
+            for query in [u'title:title', u'title::^title']:
+                chunks = list(plugin.item_chunks(self.lib, [query]))
+                self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+                self.assertEqual(
+                    sorted(path for chunk in chunks for _, path in chunk),
+                    [os.path.join(self.import_dir, '%i.mp3' % i)
+                     for i in range(5)])
+        finally:
+            dirfields.BACKFILL_CHUNK_SIZE = chunk_size
+
+    def test_backfill_keeps_imported_fields(self):
+        config['dirfields']['levels'] = '1-'
+        path = os.path.join(self.import_dir, 'track.mp3')
+        dirs = split_path(path)
+        # The fields were set from the path the item was imported from
+        item = Item(path=path, title=u'title', dir1=u'source')
+        self.lib.add(item)
+        other = Item(path=path, title=u'title')
+        self.lib.add(other)
+
+        plugin = DirFieldsPlugin()
+        plugin.backfill_command(self.lib, Options(), [])
+        item = self.lib.get_item(item.id)
+        self.assertEqual(item['dir1'], u'source')
+        self.assertNotIn('dir2', item)
+        self.assertEqual(self.lib.get_item(other.id)['dir1'], dirs[1])
+
+        plugin.backfill_command(self.lib, Options(force=True), [])
+        item = self.lib.get_item(item.id)
+        self.assertEqual(item['dir1'], dirs[1])
+        self.assertEqual(item['dir2'], dirs[2])
+
+    def test_index(self):
+        path = os.path.join(self.import_dir, 'track.mp3')
+        dirs = split_path(path)
+        folder_level = len(dirs) - 2
+        config['dirfields']['index'] = True
+        config['dirfields']['dir%i' % folder_level] = 'foo'
+        item = Item(path=path, title=u'title')
+        self.lib.add(item)
+        other = Item(path=os.path.join(self.temp_dir, 'track.mp3'))
+        self.lib.add(other)
+
+        plugin = DirFieldsPlugin()
+        plugin.create_index(self.lib)
+        plugin.backfill_command(self.lib, Options(), [])
+
+        folder = dirs[folder_level].decode('utf-8')
+        query = DirFieldQuery('foo', folder)
+        self.assertEqual([i.id for i in self.lib.items(query)], [item.id])
+        query = DirFieldQuery('dir1', folder)
+        self.assertEqual(list(self.lib.items(query)), [])
+        query = DirFieldQuery('dir%i' % (len(dirs) - 1), u'track.mp3')
+        self.assertEqual([i.id for i in self.lib.items(query)], [item.id])
+
+        item.remove()
+        with self.lib.transaction() as tx:
+            rows = tx.query('SELECT item_id FROM dirfields_index '
+                            'WHERE item_id = ?', (item.id,))
+        self.assertEqual(rows, [])
+
+    def test_index_albums_and_slow_path(self):
+        path = os.path.join(self.import_dir, 'track.mp3')
+        dirs = split_path(path)
+        folder_level = len(dirs) - 2
+        config['dirfields']['index'] = True
+        config['dirfields']['dir%i' % folder_level] = 'foo'
+        self.unload_plugins()
+        self.load_plugins('dirfields')
+        self.lib.add(Item(path=os.path.join(self.temp_dir, 'single.mp3')))
+        album = self.lib.add_album([Item(path=path, title=u'title')])
+        other_album = self.lib.add_album([
+            Item(path=os.path.join(self.temp_dir, 'track.mp3'))])
+        # Album ids must not be taken for item ids
+        self.assertNotEqual(album.id, album.items().get().id)
+
+        plugin = DirFieldsPlugin()
+        plugin.create_index(self.lib)
+        plugin.backfill_command(self.lib, Options(), [])
+
+        folder = dirs[folder_level].decode('utf-8')
+        self.assertEqual([a.id for a in self.lib.albums(u'foo:%' + folder)],
+                         [album.id])
+        self.assertEqual(list(self.lib.albums(u'dir1:%' + folder)), [])
+        self.assertEqual([a.id for a in self.lib.albums(u'any:%' + folder)],
+                         [album.id])
+        self.assertEqual(
+            [i.id for i in self.lib.items(u'any:@' + folder)],
+            [i.id for i in album.items()])
+        self.assertEqual(AlbumDirFieldQuery('foo', folder).clause(),
+                         ('id IN (SELECT album_id FROM items WHERE id IN '
+                          '(SELECT item_id FROM dirfields_index '
+                          'WHERE name = ? AND level = ?))',
+                          [folder, folder_level]))
+
+        # The slow path, used if the query is combined with a slow query,
+        # gives the same results
+        for field in ['foo', 'dir1', 'any']:
+            for model_cls, query_cls, objs in [
+                    (Item, DirFieldQuery, self.lib.items()),
+                    (Album, AlbumDirFieldQuery, self.lib.albums())]:
+                query = query_cls(field, folder)
+                fast = set(obj.id for obj in self.lib._fetch(model_cls,
+                                                             query))
+                slow = set(obj.id for obj in objs if query.match(obj))
+                self.assertEqual(fast, slow)
+        self.assertEqual(
+            [a.id for a in self.lib.albums(u'foo:%{0} flex:x'.format(folder))],
+            [])
+        other_album['flex'] = u'x'
+        other_album.store()
+        album['flex'] = u'x'
+        album.store()
+        self.assertEqual(
+            [a.id for a in self.lib.albums(u'foo:%{0} flex:x'.format(folder))],
+            [album.id])
@@ -0,0 +1,164 @@
+# This file is part of beets.
+# Copyright 2016, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+import json
+import os
+import random
+import threading
+import time
+from beets import config
+import beetsplug
+from beetsplug.multipletaskcreated import MultipleTaskCreated
+from test import _common
+from test.helper import TestHelper
+
+
+class Task(object):
+    def __init__(self, name):
+        self.name = name
+        self.paths = [name]
+        # Names of the plugins which got the task, in order
+        self.calls = []
+
+    def __repr__(self):
+        return 'Task({0!r})'.format(self.name)
+
+
+class FanOutPlugin(object):
+    """Splits a task into count tasks."""
+    name = 'fanout'
+
+    def __init__(self, count):
+        self.count = count
+
+    def import_task_created_event(self, session, task, chained=False):
+        task.calls.append(self.name)
+        return [Task('{0}.{1}'.format(task.name, i))
+                for i in range(self.count)]
+
+
+class RecordingPlugin(object):
+    """Records the tasks it gets after a random delay. Returns None for
+    every task, so the tasks pass unchanged, or drops the tasks whose name
+    ends with drop."""
+    def __init__(self, name, drop=None):
+        self.name = name
+        self.drop = drop
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def import_task_created_event(self, session, task, chained=False):
+        time.sleep(random.random() * 0.01)
+        with self.lock:
+            self.threads.add(threading.current_thread().ident)
+        task.calls.append(self.name)
+        if self.drop is None:
+            return None
+        return [] if task.name.endswith(self.drop) else [task]
+
+
+class MultipleTaskCreatedTest(_common.TestCase, TestHelper):
+    """ Test the multipletaskcreated plugin
+    """
+
+    def setUp(self):
+        super(MultipleTaskCreatedTest, self).setUp()
+        self.setup_beets()
+        config['pluginpath'] = [os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                                             "beetsplug")]
+        beetsplug.__path__ = config['pluginpath'].get() + beetsplug.__path__
+
+    def tearDown(self):
+        self.teardown_beets()
+
+    def __run_chain(self, threads):
+        config['multipletaskcreated']['threads'] = threads
+        chain = MultipleTaskCreated()
+        first = RecordingPlugin('first')
+        second = RecordingPlugin('second', drop='.3')
+        # Only the tasks created by the first plugin are spread over the
+        # threads
+        chain.plugins = [FanOutPlugin(20), first, second]
+        tasks = []
+        for name in ['a', 'b']:
+            tasks.extend(chain.import_task_created_event(None, Task(name)))
+        chain.import_event(self.lib, [])
+        return tasks, first
+
+    def test_order(self):
+        for threads in [0, 4]:
+            tasks, first = self.__run_chain(threads)
+            self.assertEqual([task.name for task in tasks],
+                             ['{0}.{1}'.format(name, i)
+                              for name in ['a', 'b'] for i in range(20)
+                              if i != 3])
+            for task in tasks:
+                self.assertEqual(task.calls, ['first', 'second'])
+            if threads:
+                self.assertGreater(len(first.threads), 1)
+            else:
+                self.assertEqual(first.threads,
+                                 set([threading.current_thread().ident]))
+
+    def test_plugin_order(self):
+        config['multipletaskcreated']['threads'] = 4
+        chain = MultipleTaskCreated()
+        first = RecordingPlugin('first')
+        chain.plugins = [first, RecordingPlugin('second'),
+                         RecordingPlugin('third')]
+        tasks = [Task(str(i)) for i in range(10)]
+        out = []
+        for task in tasks:
+            out.extend(chain.import_task_created_event(None, task))
+        chain.import_event(self.lib, [])
+        # None keeps the task itself
+        self.assertEqual(out, tasks)
+        for task in tasks:
+            self.assertEqual(task.calls, ['first', 'second', 'third'])
+
+    def test_record(self):
+        trace_file = os.path.join(self.temp_dir, 'trace.json')
+        config['multipletaskcreated']['trace_file'] = trace_file
+        chain = MultipleTaskCreated()
+        chain.plugins = [FanOutPlugin(3), RecordingPlugin('second',
+                                                          drop='.1')]
+        tasks = list(chain.import_task_created_event(None, Task('a')))
+        self.assertEqual([task.name for task in tasks], ['a.0', 'a.2'])
+
+        self.assertEqual(list(chain.stats), ['fanout', 'second'])
+        self.assertEqual(chain.stats['fanout']['tasks_in'], 1)
+        self.assertEqual(chain.stats['fanout']['tasks_out'], 3)
+        self.assertEqual(chain.stats['second']['tasks_in'], 3)
+        self.assertEqual(chain.stats['second']['tasks_out'], 2)
+        self.assertGreater(chain.stats['second']['time'], 0)
+
+        chain.import_event(self.lib, [])
+        self.assertEqual(chain.stats, {})
+        self.assertIsNone(chain.trace)
+        with open(trace_file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([(line['plugin'], line['task'], line['tasks_out'])
+                          for line in lines],
+                         [('fanout', 'a', 3), ('second', 'a.0', 1),
+                          ('second', 'a.1', 0), ('second', 'a.2', 1)])
+        for line in lines:
+            self.assertGreaterEqual(line['time'], 0)
+
+        # The next session starts with new statistics and appends to the
+        # trace
+        list(chain.import_task_created_event(None, Task('b')))
+        self.assertEqual(chain.stats['fanout']['tasks_in'], 1)
+        chain.import_event(self.lib, [])
+        with open(trace_file) as f:
+            self.assertEqual(len(f.readlines()), 8)
@@ -0,0 +1,358 @@
+# This file is part of beets.
+# Copyright 2016, Malte Ried
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+import os
+import shutil
+import struct
+import threading
+import time
+from io import BytesIO
+from beets import config
+from beets.importer import ImportTask
+from beets.library import Item, PathQuery
+from beets.mediafile import MediaFile
+import beetsplug
+from beetsplug import dircache
+from beetsplug.notagain import NotAgain, PRESCAN_CHUNK_SIZE, audio_range, \
+    content_fingerprint
+from test import _common
+from test.helper import TestHelper
+
+
+class Session(object):
+    """The parts of an import session used by the plugin."""
+    def __init__(self, lib, paths=None):
+        self.lib = lib
+        self.paths = paths or []
+
+
+class NotAgainPluginTest(_common.TestCase, TestHelper):
+    """ Test the notagain plugin
+    """
+
+    def setUp(self):
+        super(NotAgainPluginTest, self).setUp()
+        self.setup_beets()
+        config['pluginpath'] = [os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                                             "beetsplug")]
+        beetsplug.__path__ = config['pluginpath'].get() + beetsplug.__path__
+        config['notagain']['state_file'] = os.path.join(self.temp_dir,
+                                                        'notagain.pickle')
+
+    def tearDown(self):
+        self.teardown_beets()
+
+    def __add_item(self, *path):
+        item = Item(path=os.path.join(self.libdir, *path), title=u'title')
+        self.lib.add(item)
+        return item
+
+    def test_library_paths(self):
+        items = [self.__add_item('a', '01 - track.mp3'),
+                 self.__add_item('a', '02 - track.mp3')]
+        plugin = NotAgain()
+        loads = []
+        load_library_paths = plugin.load_library_paths
+
+        def counting_load_library_paths(session):
+            loads.append(session)
+            load_library_paths(session)
+        plugin.load_library_paths = counting_load_library_paths
+
+        session = Session(self.lib)
+        paths = [item.path for item in items] + [
+            os.path.join(self.libdir, 'a', '03 - track.mp3'),
+            os.path.join(self.libdir, 'b', '01 - track.mp3')]
+        for path in paths:
+            self.assertEqual(plugin.in_library(session, path),
+                             self.lib.items(PathQuery('path', path)).get()
+                             is not None)
+        self.assertEqual(len(loads), 1)
+
+        # Imported items are added without reloading the paths
+        item = self.__add_item('a', '03 - track.mp3')
+        plugin.item_imported_event(self.lib, item)
+        album = self.lib.add_album([Item(path=os.path.join(
+            self.libdir, 'b', '01 - track.mp3'), title=u'title')])
+        plugin.album_imported_event(self.lib, album)
+        for path in paths:
+            self.assertTrue(plugin.in_library(session, path))
+        self.assertEqual(len(loads), 1)
+
+        # A new session reads the paths again
+        plugin.import_event(self.lib, [])
+        self.assertTrue(plugin.in_library(Session(self.lib), paths[0]))
+        self.assertEqual(len(loads), 2)
+
+    def test_library_paths_threads(self):
+        item = self.__add_item('a', '01 - track.mp3')
+        plugin = NotAgain()
+        loads = []
+        load_library_paths = plugin.load_library_paths
+
+        def slow_load_library_paths(session):
+            loads.append(session)
+            time.sleep(0.1)
+            load_library_paths(session)
+        plugin.load_library_paths = slow_load_library_paths
+
+        session = Session(self.lib)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            plugin.in_library(session, item.path))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 4)
+        self.assertEqual(len(loads), 1)
+
+    def __create_files(self, *paths):
+        """Creates empty files and returns their paths."""
+        full_paths = []
+        for path in paths:
+            full_path = os.path.join(self.libdir, *path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            open(full_path, 'wb').close()
+            full_paths.append(full_path)
+        return full_paths
+
+    def test_unchanged_directory_skipped_before_reading(self):
+        config['notagain']['dir_fingerprints'] = True
+        album_files = self.__create_files(('artist', 'album', '01 - a.mp3'),
+                                          ('artist', 'album', '02 - b.mp3'))
+        new_files = self.__create_files(('artist', 'new', '01 - a.mp3'))
+        for path in album_files:
+            self.lib.add(Item(path=path, title=u'title'))
+        album_path = os.path.dirname(album_files[0])
+        artist_path = os.path.dirname(album_path)
+        plugin = NotAgain()
+        plugin.record_directory(album_path, album_files)
+
+        session = Session(self.lib, [artist_path])
+        plugin.import_begin_event(session)
+        self.assertEqual(session.paths, [os.path.dirname(new_files[0])])
+
+        # A changed directory reaches beets again
+        self.__create_files(('artist', 'album', '03 - c.mp3'))
+        session = Session(self.lib, [artist_path])
+        plugin.import_begin_event(session)
+        self.assertEqual(sorted(session.paths),
+                         sorted([album_path, os.path.dirname(new_files[0])]))
+
+    def test_find_in_library(self):
+        known = [self.__add_item('a', '%03d - track.mp3' % i).path
+                 for i in range(PRESCAN_CHUNK_SIZE + 10)]
+        unknown = [os.path.join(self.libdir, 'b', '%03d - track.mp3' % i)
+                   for i in range(PRESCAN_CHUNK_SIZE + 10)]
+        self.assertEqual(NotAgain.find_in_library(self.lib, known + unknown),
+                         set(known))
+        self.assertEqual(NotAgain.find_in_library(self.lib, unknown), set())
+        self.assertEqual(NotAgain.find_in_library(self.lib, []), set())
+
+    def test_prefilter(self):
+        present = self.__create_files(('artist', 'album 1', '01 - a.mp3'),
+                                      ('artist', 'album 1', 'cover.jpg'),
+                                      ('artist', 'album 2', '01 - a.mp3'),
+                                      ('other', 'album', '01 - a.mp3'))
+        new = self.__create_files(('artist', 'album 2', '02 - b.mp3'))
+        for path in present:
+            if path.endswith('.mp3'):
+                self.lib.add(Item(path=path, title=u'title'))
+        plugin = NotAgain()
+        session = Session(self.lib, [self.libdir])
+        paths, skipped = plugin.prefilter(session, session.paths,
+                                          dircache.DirectoryCache())
+        self.assertEqual(paths, [os.path.dirname(new[0])])
+        self.assertEqual(skipped, 2)
+
+        # A fully present import path is left out, single files are kept
+        single = os.path.join(self.temp_dir, 'single.mp3')
+        session = Session(self.lib, [os.path.dirname(present[0]), single])
+        paths, skipped = plugin.prefilter(session, session.paths,
+                                          dircache.DirectoryCache())
+        self.assertEqual(paths, [single])
+        self.assertEqual(skipped, 1)
+
+    def test_prefilter_unlisted_extensions(self):
+        present = self.__create_files(('artist', 'album', '01 - a.mp3'),
+                                      ('artist', 'album', 'cover.jpg'),
+                                      ('artist', 'album', 'album.cue'))
+        new = self.__create_files(('artist', 'book', '01 - a.m4b'),
+                                  ('artist', 'other', 'track.aifc'))
+        self.lib.add(Item(path=present[0], title=u'title'))
+        plugin = NotAgain()
+        session = Session(self.lib, [self.libdir])
+        paths, skipped = plugin.prefilter(session, session.paths,
+                                          dircache.DirectoryCache())
+        self.assertEqual(sorted(paths),
+                         sorted(os.path.dirname(path) for path in new))
+        self.assertEqual(skipped, 1)
+
+    def test_prefilter_keeps_multi_disc_albums(self):
+        present = self.__create_files(('artist', 'album', 'CD1', '01 - a.mp3'))
+        self.__create_files(('artist', 'album', 'CD2', '01 - a.mp3'))
+        self.lib.add(Item(path=present[0], title=u'title'))
+        plugin = NotAgain()
+        session = Session(self.lib, [self.libdir])
+        paths, skipped = plugin.prefilter(session, session.paths,
+                                          dircache.DirectoryCache())
+        self.assertEqual(paths, [os.path.join(self.libdir, 'artist',
+                                              'album')])
+        self.assertEqual(skipped, 0)
+
+    def test_toppath_restored(self):
+        config['notagain']['prefilter'] = True
+        self.__create_files(('artist', 'album 1', '01 - a.mp3'))
+        new = self.__create_files(('artist', 'album 2', '01 - a.mp3'))
+        self.lib.add(Item(path=os.path.join(self.libdir, 'artist', 'album 1',
+                                            '01 - a.mp3'), title=u'title'))
+        plugin = NotAgain()
+        session = Session(self.lib, [self.libdir])
+        plugin.import_begin_event(session)
+        album_path = os.path.dirname(new[0])
+        self.assertEqual(session.paths, [album_path])
+        self.assertEqual(session.original_paths, [self.libdir])
+
+        task = ImportTask(album_path, [album_path], [Item(path=new[0])])
+        plugin.restore_toppath(session, task)
+        self.assertEqual(task.toppath, self.libdir)
+        task = ImportTask(self.temp_dir, [self.temp_dir], [])
+        plugin.restore_toppath(session, task)
+        self.assertEqual(task.toppath, self.temp_dir)
+
+    def test_audio_range_id3(self):
+        audio = b'A' * 1000
+        id3v2 = b'ID3\x04\x00\x00\x00\x00\x00\x14' + b'T' * 20
+        id3v1 = b'TAG' + b'V' * 125
+        data = id3v2 + audio + id3v1
+        self.assertEqual(audio_range(BytesIO(data), len(data)),
+                         (30, 1030))
+
+        # Two tags, the second one with a footer
+        id3v2_footer = b'ID3\x04\x00\x10\x00\x00\x01\x00' + b'T' * 128 + \
+            b'3DI' + b'F' * 7
+        data = id3v2 + id3v2_footer + audio
+        self.assertEqual(audio_range(BytesIO(data), len(data)),
+                         (30 + 148, 30 + 148 + 1000))
+
+    def test_audio_range_ape(self):
+        audio = b'A' * 1000
+        items = b'I' * 16
+        header = b'APETAGEX' + b'H' * 24
+        footer = b'APETAGEX' + struct.pack('<IIII', 2000, len(items) + 32, 1,
+                                           0x80000000) + b'\x00' * 8
+        id3v1 = b'TAG' + b'V' * 125
+        data = audio + header + items + footer + id3v1
+        self.assertEqual(audio_range(BytesIO(data), len(data)), (0, 1000))
+
+    def test_audio_range_flac(self):
+        audio = b'A' * 1000
+        data = b'fLaC' + b'\x00\x00\x00\x22' + b'S' * 34 + \
+            b'\x81\x00\x00\x0a' + b'P' * 10 + audio
+        self.assertEqual(audio_range(BytesIO(data), len(data)),
+                         (56, 1056))
+
+    def test_audio_range_untagged(self):
+        data = b'A' * 1000
+        self.assertEqual(audio_range(BytesIO(data), len(data)), (0, 1000))
+
+    def test_content_fingerprint_ignores_tags(self):
+        for name in ['full.mp3', 'full.flac']:
+            path = os.path.join(self.temp_dir, name)
+            shutil.copy(os.path.join(_common.RSRC, name), path)
+            fingerprint = content_fingerprint(path, 1024 * 1024)
+            size = os.path.getsize(path)
+
+            medium = MediaFile(path)
+            medium.title = u'A much longer title than before ' * 200
+            medium.comments = u'Some comment'
+            medium.save()
+            self.assertNotEqual(os.path.getsize(path), size)
+            self.assertEqual(content_fingerprint(path, 1024 * 1024),
+                             fingerprint)
+            # Only the first and last chunk are hashed
+            self.assertEqual(content_fingerprint(path, 64)[0],
+                             fingerprint[0])
+
+            # A change of the audio data changes the fingerprint
+            with open(path, 'r+b') as f:
+                start, _ = audio_range(f, os.path.getsize(path))
+                f.seek(start)
+                byte = f.read(1)
+                f.seek(start)
+                f.write(b'\x00' if byte != b'\x00' else b'\x01')
+            self.assertNotEqual(content_fingerprint(path, 1024 * 1024),
+                                fingerprint)
+
+    def __copy_to_library(self, *path):
+        full_path = os.path.join(self.libdir, *path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        shutil.copy(os.path.join(_common.RSRC, 'full.mp3'), full_path)
+        return full_path
+
+    def test_content_known(self):
+        config['notagain']['content_hash'] = True
+        path = self.__copy_to_library('a', '01 - track.mp3')
+        item = Item(path=path, title=u'title')
+        self.lib.add(item)
+        plugin = NotAgain()
+        plugin.index_content(self.lib, path)
+        with self.lib.transaction() as tx:
+            rows = tx.query('SELECT path FROM notagain_content')
+        self.assertEqual([bytes(row[0]) for row in rows], [path])
+
+        # The same content somewhere else is known
+        copy = os.path.join(self.temp_dir, 'copy.mp3')
+        shutil.copy(path, copy)
+        medium = MediaFile(copy)
+        medium.title = u'Other title'
+        medium.save()
+        self.assertTrue(plugin.item_known(Session(self.lib),
+                                          Item(path=copy), self.libdir))
+        # Other content is not
+        other = os.path.join(self.temp_dir, 'other.flac')
+        shutil.copy(os.path.join(_common.RSRC, 'full.flac'), other)
+        self.assertFalse(plugin.item_known(Session(self.lib),
+                                           Item(path=other), self.libdir))
+
+    def test_relink(self):
+        config['notagain']['content_hash'] = True
+        config['notagain']['relink'] = True
+        path = self.__copy_to_library('a', '01 - track.mp3')
+        item = Item(path=path, title=u'title')
+        self.lib.add(item)
+        plugin = NotAgain()
+        plugin.index_content(self.lib, path)
+
+        new_path = os.path.join(self.libdir, 'b', '01 - track.mp3')
+        os.makedirs(os.path.dirname(new_path))
+        os.rename(path, new_path)
+        session = Session(self.lib)
+        self.assertTrue(plugin.item_known(session, Item(path=new_path),
+                                          self.libdir))
+        self.assertEqual(self.lib.get_item(item.id).path, new_path)
+        self.assertTrue(plugin.in_library(session, new_path))
+        self.assertFalse(plugin.in_library(session, path))
+
+        # Without relink, the moved file is imported again
+        config['notagain']['relink'] = False
+        newer_path = os.path.join(self.libdir, 'c.mp3')
+        os.rename(new_path, newer_path)
+        self.assertFalse(plugin.item_known(Session(self.lib),
+                                           Item(path=newer_path),
+                                           self.libdir))
+        self.assertEqual(self.lib.get_item(item.id).path, new_path)
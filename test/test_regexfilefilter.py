@@ -18,7 +18,7 @@ import unittest
 from beets import config
 from beets.mediafile import MediaFile
 import beetsplug
-from beetsplug.regexfilefilter import RegexFileFilterPlugin
+from beetsplug.regexfilefilter import RegexFileFilterPlugin, Rule, RuleSet
 from test import _common
 from test.helper import capture_log
 from test.test_importer import ImportHelper
@@ -329,6 +329,165 @@ class RegexFileFilterPluginTest(_common.TestCase, ImportHelper):
         self.__run([self.misc_paths[0],
                     self.misc_paths[1]], singletons=True)
 
+    # Rules
+    def test_import_rules(self):
+        self.__reset_config()
+        config['regexfilefilter']['rules'] = [
+            {'exclude_folder': 'misc'},
+            {'include_file_prefix': '01'},
+            {'include_file': 'track_2'},
+            {'exclude_file_suffix': '.mp3'}]
+        self.__run([self.artist_paths[1],
+                    self.album_paths[0]])
+
+    def test_import_singleton_rules(self):
+        self.__reset_config()
+        config['regexfilefilter']['rules'] = [{'exclude_folder': 'misc'}]
+        config['regexfilefilter']['singleton']['rules'] = [
+            {'exclude_folder': 'artist'}]
+        self.__run([self.artist_paths[0],
+                    self.artist_paths[1],
+                    self.album_paths[0],
+                    self.album_paths[1]])
+        self.__run([self.misc_paths[0],
+                    self.misc_paths[1]], singletons=True)
+
+    def test_rule_set_first_match(self):
+        rules = RuleSet([Rule.from_config(rule) for rule in [
+            {'exclude_file_suffix': '.jpg'},
+            {'include_file': '(a)(b)'},
+            {'include_file': r'(c)\1'},
+            {'exclude_file': 'a'},
+            {'include_file_prefix': 'a'}]])
+        self.assertEqual(str(rules.match('ab.jpg')),
+                         'exclude_file_suffix: .jpg')
+        self.assertEqual(str(rules.match('ab.mp3')), 'include_file: (a)(b)')
+        self.assertEqual(str(rules.match('cc.mp3')), r'include_file: (c)\1')
+        self.assertEqual(str(rules.match('ac.mp3')), 'exclude_file: a')
+        self.assertIsNone(rules.match('x.mp3'))
+        self.assertTrue(rules.allowed('x.mp3'))
+        self.assertFalse(rules.allowed('ac.mp3'))
+
+    def test_non_ascii_rules(self):
+        rules = RuleSet([Rule.from_config(rule) for rule in [
+            {'exclude_folder_prefix': u'H\xf6rbuch'},
+            {'exclude_folder': u'.*B\xfccher'}]])
+        rule = rules.match(u'H\xf6rbuch 1'.encode('utf-8'))
+        self.assertEqual(unicode(rule),
+                         u'exclude_folder_prefix: H\xf6rbuch')
+        self.assertEqual(str(rule), 'exclude_folder_prefix: H\xc3\xb6rbuch')
+        rule = rules.match(u'Alte B\xfccher'.encode('utf-8'))
+        self.assertEqual(unicode(rule), u'exclude_folder: .*B\xfccher')
+        self.assertIsNone(rules.match(b'Buecher'))
+
+        self.__reset_config()
+        config['regexfilefilter']['rules'] = [
+            {'exclude_folder_prefix': u'H\xf6rbuch'},
+            {'exclude_folder': u'.*B\xfccher'}]
+        plugin = RegexFileFilterPlugin()
+        for folder in [u'H\xf6rbuch 1', u'Alte B\xfccher']:
+            path = os.path.join(self.import_dir,
+                                folder.encode('utf-8'), b'01 - track.mp3')
+            self.assertFalse(plugin.file_filter(path, [self.import_dir]))
+        self.assertTrue(plugin.file_filter(self.album_paths[0],
+                                           [self.import_dir]))
+
+    def test_folder_verdict_cached(self):
+        self.__reset_config()
+        config['regexfilefilter']['folder_name_regex'] = 'artist|album'
+        plugin = RegexFileFilterPlugin()
+        calls = []
+        folder_rejection = plugin.folder_rejection
+
+        def counting_folder_rejection(path, singletons):
+            calls.append(path)
+            return folder_rejection(path, singletons)
+        plugin.folder_rejection = counting_folder_rejection
+
+        class Session(object):
+            paths = [self.import_dir]
+        plugin.prepare_session(Session())
+
+        for path in self.album_paths + self.album_paths:
+            self.assertTrue(plugin.item_filter(path))
+        for path in self.misc_paths:
+            self.assertFalse(plugin.item_filter(path))
+        self.assertEqual(len(calls), 2)
+
+        for path in self.album_paths + self.misc_paths:
+            self.assertEqual(plugin.item_filter(path),
+                             plugin.file_filter(path, [self.import_dir]))
+
+    def test_original_paths(self):
+        self.__reset_config()
+        config['regexfilefilter']['folder_name_regex'] = 'artist|album'
+        plugin = RegexFileFilterPlugin()
+
+        # The import path was narrowed down by another plugin
+        class Session(object):
+            paths = [os.path.dirname(self.misc_paths[0])]
+            original_paths = [self.import_dir]
+        plugin.prepare_session(Session())
+
+        for path in self.misc_paths:
+            self.assertFalse(plugin.item_filter(path))
+        for path in self.album_paths:
+            self.assertTrue(plugin.item_filter(path))
+
+    def test_prune_walk(self):
+        self.__reset_config()
+        config['regexfilefilter']['prune_walk'] = True
+        config['regexfilefilter']['folder_name_regex'] = 'artist|album'
+        config['regexfilefilter']['file_name_regex'] = '.*1.*'
+        config['ignore'] = ['.*']
+        plugin = RegexFileFilterPlugin()
+
+        class Session(object):
+            paths = [self.import_dir]
+        plugin.import_begin_event(Session())
+        # track_2.mp3 and 02 - track.mp3 are rejected, but other .mp3 files
+        # are accepted, so the names are ignored instead of the extension.
+        self.assertEqual(config['ignore'].as_str_seq(),
+                         ['.*', '02 - track.mp3', 'misc', 'track_2.mp3'])
+
+        plugin.import_event(None, None)
+        self.assertEqual(config['ignore'].as_str_seq(), ['.*'])
+
+    def test_stats(self):
+        self.__reset_config()
+        config['regexfilefilter']['folder_name_regex'] = 'artist|album'
+        config['regexfilefilter']['rules'] = [{'exclude_file_prefix': '02'}]
+        plugin = RegexFileFilterPlugin()
+
+        class Session(object):
+            paths = [self.import_dir]
+        plugin.prepare_session(Session())
+        for path in self.all_paths:
+            plugin.item_filter(path)
+
+        stats = plugin.get_stats()
+        self.assertEqual(stats['checked_files'], 6)
+        self.assertGreater(stats['filter_time'], 0)
+        self.assertEqual(stats['rejected_files'],
+                         {'folder_name_regex (album)': 2,
+                          'exclude_file_prefix: 02': 1})
+        self.assertEqual(stats['rejected_folders'],
+                         {'folder_name_regex (album)': 1})
+        for key in list(stats['rejected_files']) + \
+                list(stats['rejected_folders']):
+            self.assertIsInstance(key, unicode)
+
+        # Non-ASCII rules are counted by their unicode description
+        config['regexfilefilter']['rules'] = [
+            {'exclude_file_prefix': u'\xdcber'}]
+        plugin = RegexFileFilterPlugin()
+        plugin.prepare_session(Session())
+        path = os.path.join(self.import_dir, 'artist',
+                            u'\xdcber.mp3'.encode('utf-8'))
+        self.assertFalse(plugin.item_filter(path))
+        self.assertEqual(plugin.get_stats()['rejected_files'],
+                         {u'exclude_file_prefix: \xdcber': 1})
+
 
 def suite():
     return unittest.TestLoader().loadTestsFromName(__name__)